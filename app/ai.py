@@ -1,36 +1,314 @@
 import os
+import asyncio
+import hashlib
+import json
+import time
+from collections import deque
 from openai import AsyncOpenAI
 import logging
-from cachetools import TTLCache  # Кэш на 5 мин
+from cachetools import TTLCache  # LRU по размеру + TTL
+from .ai_queue import AIJobQueue, SlotTimeout, INTERACTIVE, BACKGROUND, PRIORITY_NAMES
+from .metrics import registry, AI_REPLY, AI_UPSTREAM
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 OPENAI_API_KEY = os.environ.get('OPENAI_API_KEY')
 MODEL = os.environ.get('OPENAI_MODEL', 'gpt-4o-mini')
+OPENAI_BASE_URL = os.environ.get('OPENAI_BASE_URL')  # Например, локальный bench/fake_openai.py для нагрузочных тестов
 
-client = AsyncOpenAI(api_key=OPENAI_API_KEY)
-cache = TTLCache(maxsize=100, ttl=300)  # Кэш AI-ответов
+AI_CACHE_SIZE = int(os.environ.get('AI_CACHE_SIZE', 1000))
+AI_CACHE_TTL = float(os.environ.get('AI_CACHE_TTL', 300))  # Кэш на 5 мин
+AI_DISK_CACHE = os.environ.get('AI_DISK_CACHE')  # Путь к SQLite-файлу; не задан — только память
+AI_DISK_CACHE_TTL = float(os.environ.get('AI_DISK_CACHE_TTL', 86400))
+AI_DISK_CACHE_MAX = int(os.environ.get('AI_DISK_CACHE_MAX', 100000))  # Строк в дисковом кэше; сверх — вытесняются самые старые
+AI_WORKERS = int(os.environ.get('AI_WORKERS', os.environ.get('AI_MAX_CONCURRENCY', 4)))  # Одновременных запросов к OpenAI
+AI_BG_CALLS_PER_MIN = int(os.environ.get('AI_BG_CALLS_PER_MIN', 60))  # Бюджет фоновых вызовов
+AI_BG_TOKENS_PER_MIN = int(os.environ.get('AI_BG_TOKENS_PER_MIN', 20000))
+AI_BG_OVERFLOW = os.environ.get('AI_BG_OVERFLOW', 'degrade')  # degrade — шаблонный текст, shed — пропустить действие
+AI_QUEUE_TIMEOUT = float(os.environ.get('AI_QUEUE_TIMEOUT', 30))  # Сколько ждать свободного слота
+AI_BG_QUEUE_TIMEOUT = float(os.environ.get('AI_BG_QUEUE_TIMEOUT', 0))  # То же для фона; 0 — не ждать, сразу degrade/shed
+AI_REQUEST_TIMEOUT = float(os.environ.get('AI_REQUEST_TIMEOUT', 30))
+FALLBACK_REPLY = "(NPC временно молчит — ошибка AI)"
 
-async def generate_reply(system_prompt: str, history: list, user_message: str):
-    key = f"{system_prompt}:{user_message}:{str(history[-3:])}"  # Ключ кэша
-    if key in cache:
-        return cache[key]
+client = AsyncOpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL)
+cache = TTLCache(maxsize=AI_CACHE_SIZE, ttl=AI_CACHE_TTL)  # Кэш AI-ответов
+inflight = {}  # (key, priority) -> Task: одинаковые запросы ждут один вызов
+jobs = AIJobQueue(AI_WORKERS, AI_BG_CALLS_PER_MIN, AI_BG_TOKENS_PER_MIN, AI_BG_OVERFLOW)
+
+class AIStats:
+    def __init__(self, window: int = 1000):
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.latencies = deque(maxlen=window)  # Секунды реальных вызовов OpenAI
+        self.ttft = deque(maxlen=window)  # Время до первого токена в потоковом режиме
+
+    def as_dict(self):
+        lat = sorted(self.latencies)
+        ttft = sorted(self.ttft)
+        pct = lambda xs, p: round(xs[min(len(xs) - 1, int(len(xs) * p))] * 1000, 1) if xs else 0.0
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+            "in_flight": len(inflight),
+            "queued": sum(st.waiting for st in jobs.classes.values()),
+            "latency_p50_ms": pct(lat, 0.5),
+            "latency_p99_ms": pct(lat, 0.99),
+            "ttft_p50_ms": pct(ttft, 0.5),
+            "ttft_p99_ms": pct(ttft, 0.99),
+            "cache_size": len(cache),
+        }
+
+stats = AIStats()
+
+registry.callback('ai_cache_requests_total', 'Запросы к кэшу AI-ответов по результату',
+                  lambda: {'hit': stats.hits, 'disk_hit': stats.disk_hits, 'miss': stats.misses, 'coalesced': stats.coalesced},
+                  ('result',), kind='counter')
+registry.callback('ai_errors_total', 'Ошибки и таймауты вызовов OpenAI',
+                  lambda: {'error': stats.errors, 'timeout': stats.timeouts}, ('kind',), kind='counter')
+registry.callback('ai_in_flight', 'Уникальных запросов к OpenAI в полёте', lambda: len(inflight))
+registry.callback('ai_queue_waiting', 'Ожидают слота к OpenAI',
+                  lambda: {PRIORITY_NAMES[p]: st.waiting for p, st in jobs.classes.items()}, ('priority',))
+
+class DiskCache:
+    """Второй уровень кэша в SQLite: переживает перезапуски.
+
+    Каждые prune_every записей удаляет просроченные строки и самые старые сверх max_rows.
+    """
+
+    def __init__(self, path: str, ttl: float, max_rows: int = AI_DISK_CACHE_MAX, prune_every: int = 100):
+        self.path = path
+        self.ttl = ttl
+        self.max_rows = max_rows
+        self.prune_every = prune_every
+        self.writes = 0
+        self.evicted = 0
+        self.conn = None
+        self.lock = asyncio.Lock()
+
+    async def _connect(self):
+        if self.conn is None:
+            import aiosqlite
+            self.conn = await aiosqlite.connect(self.path)
+            await self.conn.execute("PRAGMA journal_mode=WAL")
+            await self.conn.execute("CREATE TABLE IF NOT EXISTS ai_cache (key TEXT PRIMARY KEY, reply TEXT, created REAL)")
+            await self.conn.execute("CREATE INDEX IF NOT EXISTS ix_ai_cache_created ON ai_cache (created)")  # Для вытеснения
+            await self.conn.commit()
+        return self.conn
+
+    async def get(self, key: str):
+        async with self.lock:
+            conn = await self._connect()
+            async with conn.execute("SELECT reply, created FROM ai_cache WHERE key = ?", (key,)) as cur:
+                row = await cur.fetchone()
+        if row and time.time() - row[1] < self.ttl:
+            return row[0]
+        return None
+
+    async def set(self, key: str, reply: str):
+        async with self.lock:
+            conn = await self._connect()
+            await conn.execute("INSERT OR REPLACE INTO ai_cache (key, reply, created) VALUES (?, ?, ?)", (key, reply, time.time()))
+            if self.writes % self.prune_every == 0:  # Первая запись после старта тоже чистит
+                await self._prune(conn)
+            self.writes += 1
+            await conn.commit()
+
+    async def _prune(self, conn):
+        cur = await conn.execute("DELETE FROM ai_cache WHERE created < ?", (time.time() - self.ttl,))
+        self.evicted += cur.rowcount
+        cur = await conn.execute("DELETE FROM ai_cache WHERE key IN "
+                                 "(SELECT key FROM ai_cache ORDER BY created DESC LIMIT -1 OFFSET ?)", (self.max_rows,))
+        self.evicted += cur.rowcount
+
+    async def close(self):
+        if self.conn is not None:
+            await self.conn.close()
+            self.conn = None
+
+disk_cache = DiskCache(AI_DISK_CACHE, AI_DISK_CACHE_TTL) if AI_DISK_CACHE else None
+
+async def close_cache():
+    if disk_cache:
+        await disk_cache.close()
+
+def _normalize(text) -> str:
+    return ' '.join(str(text or '').split())
+
+def cache_key(system_prompt: str, history: list, user_message: str) -> str:
+    # Хэш нормализованного запроса вместо f-строки с str(history)
+    payload = {
+        "model": MODEL,
+        "system": _normalize(system_prompt),
+        "history": [[m.get('role'), _normalize(m.get('content'))] for m in (history or [])[-3:]],
+        "user": _normalize(user_message),
+    }
+    return hashlib.sha256(json.dumps(payload, ensure_ascii=False, sort_keys=True).encode()).hexdigest()
+
+def build_messages(system_prompt: str, history: list, user_message: str) -> list:
     messages = [{'role': 'system', 'content': system_prompt}]
     if history:
-        messages += history[-10:]
+        messages += history  # Длину истории ограничивает вызывающий (app/memory.py)
     messages.append({'role': 'user', 'content': user_message})
+    return messages
+
+def estimate_tokens(messages: list, reply: str = '') -> int:
+    # Грубо: ~4 символа на токен
+    return (sum(len(m.get('content') or '') for m in messages) + len(reply or '')) // 4
+
+async def _acquire_slot(priority: int) -> float:
     try:
-        logger.debug(f"Sending to OpenAI: {messages}")
-        response = await client.chat.completions.create(
+        return await jobs.acquire(priority, timeout=AI_BG_QUEUE_TIMEOUT if priority == BACKGROUND else AI_QUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        stats.timeouts += 1
+        raise
+
+async def _call_openai(messages: list, priority: int = INTERACTIVE):
+    wait = await _acquire_slot(priority)
+    started = time.perf_counter()
+    tokens = 0
+    try:
+        response = await asyncio.wait_for(client.chat.completions.create(
             model=MODEL,
             messages=messages,
             max_tokens=200,
             temperature=0.8,
-        )
+        ), timeout=AI_REQUEST_TIMEOUT)
         reply = response.choices[0].message.content.strip()
-        cache[key] = reply
+        usage = getattr(response, 'usage', None)
+        tokens = getattr(usage, 'total_tokens', None) or estimate_tokens(messages, reply)
         return reply
+    finally:
+        jobs.release()
+        elapsed = time.perf_counter() - started
+        stats.latencies.append(elapsed)
+        AI_UPSTREAM.observe(elapsed, PRIORITY_NAMES[priority])
+        jobs.record(priority, wait + elapsed, tokens)
+
+def _over_budget(priority: int, fallback):
+    # Бюджет фоновых вызовов исчерпан: шаблон (degrade) или None (shed)
+    degraded = jobs.overflow == 'degrade' and fallback is not None
+    jobs.record_overflow(priority, degraded)
+    return fallback if degraded else None
+
+async def _fetch(key: str, messages: list, priority: int = INTERACTIVE, fallback=None):
+    if disk_cache:
+        try:
+            reply = await disk_cache.get(key)
+        except Exception as e:
+            logger.error(f"AI disk cache error: {e}")
+            reply = None
+        if reply is not None:
+            stats.disk_hits += 1
+            cache[key] = reply
+            return reply
+    stats.misses += 1
+    if priority == BACKGROUND and AI_BG_QUEUE_TIMEOUT <= 0 and not jobs.free():
+        return _over_budget(priority, fallback)  # Все воркеры заняты, а фон не ждёт; бюджет не тратим
+    if not jobs.admit(priority):
+        return _over_budget(priority, fallback)
+    try:
+        logger.debug(f"Sending to OpenAI: {messages}")
+        reply = await _call_openai(messages, priority)
+    except Exception as e:
+        if isinstance(e, SlotTimeout) and priority == BACKGROUND:
+            return _over_budget(priority, fallback)  # Не дождались воркера за AI_BG_QUEUE_TIMEOUT
+        stats.errors += 1
+        logger.error(f"AI error: {e!r}")
+        return FALLBACK_REPLY
+    await _store(key, reply)
+    return reply
+
+async def _store(key: str, reply: str):
+    cache[key] = reply
+    if disk_cache:
+        try:
+            await disk_cache.set(key, reply)
+        except Exception as e:
+            logger.error(f"AI disk cache error: {e}")
+
+async def generate_reply(system_prompt: str, history: list, user_message: str, priority: int = INTERACTIVE, fallback: str = None):
+    """priority=BACKGROUND — фоновая работа: при исчерпанном бюджете или занятых воркерах вернёт fallback или None."""
+    started = time.perf_counter()
+    source = 'cache'
+    try:
+        key = cache_key(system_prompt, history, user_message)  # Ключ кэша
+        if key in cache:
+            stats.hits += 1
+            return cache[key]
+        flight = (key, priority)  # Фоновый отказ по бюджету не должен достаться игроку
+        if flight in inflight:  # Такой же запрос уже летит — ждём его
+            source = 'coalesced'
+            stats.coalesced += 1
+            return await asyncio.shield(inflight[flight])
+        source = 'fetch'
+        messages = build_messages(system_prompt, history, user_message)
+        # Отдельная задача: отмена первого ожидающего не отменяет ответ остальным
+        task = asyncio.create_task(_fetch(key, messages, priority, fallback))
+        inflight[flight] = task
+        task.add_done_callback(lambda _: inflight.pop(flight, None))
+        return await asyncio.shield(task)
+    finally:
+        AI_REPLY.observe(time.perf_counter() - started, PRIORITY_NAMES[priority], source)
+
+async def stream_reply(system_prompt: str, history: list, user_message: str):
+    """Потоковый режим generate_reply: асинхронный генератор токенов."""
+    key = cache_key(system_prompt, history, user_message)
+    if key in cache:
+        stats.hits += 1
+        AI_REPLY.observe(0.0, 'interactive', 'cache')
+        yield cache[key]
+        return
+    messages = build_messages(system_prompt, history, user_message)
+    stats.misses += 1
+    try:
+        wait = await _acquire_slot(INTERACTIVE)
+    except asyncio.TimeoutError:
+        yield FALLBACK_REPLY
+        return
+    parts = []
+    stream = None
+    started = time.perf_counter()
+    try:
+        stream = await asyncio.wait_for(client.chat.completions.create(
+            model=MODEL,
+            messages=messages,
+            max_tokens=200,
+            temperature=0.8,
+            stream=True,
+        ), timeout=AI_REQUEST_TIMEOUT)
+        async for chunk in stream:
+            token = chunk.choices[0].delta.content if chunk.choices else None
+            if not token:
+                continue
+            if not parts:
+                stats.ttft.append(time.perf_counter() - started)
+            parts.append(token)
+            yield token
     except Exception as e:
-        logger.error(f"AI error: {e}")
-        return "(NPC временно молчит — ошибка AI)"
\ No newline at end of file
+        stats.errors += 1
+        logger.error(f"AI stream error: {e!r}")
+        if not parts:
+            yield FALLBACK_REPLY
+        return
+    finally:
+        # Срабатывает и при отмене потребителем (закрыт сокет): закрываем HTTP-поток
+        jobs.release()
+        elapsed = time.perf_counter() - started
+        stats.latencies.append(elapsed)
+        AI_UPSTREAM.observe(elapsed, 'interactive')
+        AI_REPLY.observe(wait + elapsed, 'interactive', 'stream')
+        jobs.record(INTERACTIVE, wait + elapsed, estimate_tokens(messages, ''.join(parts)))
+        if stream is not None:
+            await stream.close()
+    reply = ''.join(parts).strip()
+    if reply:
+        await _store(key, reply)
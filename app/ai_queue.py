@@ -0,0 +1,132 @@
+import asyncio
+import heapq
+import itertools
+import time
+from collections import deque
+
+INTERACTIVE = 0  # Игрок ждёт ответа
+BACKGROUND = 1  # Фоновая болтовня NPC, best-effort
+PRIORITY_NAMES = {INTERACTIVE: 'interactive', BACKGROUND: 'background'}
+OVERFLOW_MODES = ('degrade', 'shed')
+
+class SlotTimeout(asyncio.TimeoutError):
+    """Свободный слот к OpenAI не дождались за отведённое время."""
+
+class ClassStats:
+    def __init__(self, window: int = 1000):
+        self.served = 0
+        self.shed = 0
+        self.degraded = 0
+        self.waiting = 0
+        self.waits = deque(maxlen=window)  # Ожидание слота, сек
+        self.latencies = deque(maxlen=window)  # Ожидание + вызов, сек
+
+class AIJobQueue:
+    """Приоритетная очередь на N воркеров (слотов к OpenAI) + бюджет фоновых вызовов в минуту."""
+
+    def __init__(self, workers: int, bg_calls_per_min: int, bg_tokens_per_min: int, overflow: str = 'degrade'):
+        if overflow not in OVERFLOW_MODES:
+            raise ValueError(f"Неизвестный режим переполнения бюджета: {overflow}")
+        self.workers = workers
+        self.busy = 0
+        self.waiters = []  # (priority, seq, future)
+        self.seq = itertools.count()
+        self.bg_calls_per_min = bg_calls_per_min
+        self.bg_tokens_per_min = bg_tokens_per_min
+        self.overflow = overflow
+        self.bg_calls = deque()  # Время допуска фоновых вызовов за последнюю минуту
+        self.bg_tokens = deque()  # (время, токены)
+        self.classes = {p: ClassStats() for p in PRIORITY_NAMES}
+
+    async def acquire(self, priority: int, timeout: float = None) -> float:
+        # Возвращает время ожидания слота
+        started = time.perf_counter()
+        st = self.classes[priority]
+        if self.free():
+            self.busy += 1
+        elif timeout is not None and timeout <= 0:
+            raise SlotTimeout()  # Ждать не разрешено, а свободного воркера нет
+        else:
+            fut = asyncio.get_running_loop().create_future()
+            heapq.heappush(self.waiters, (priority, next(self.seq), fut))
+            st.waiting += 1
+            try:
+                await asyncio.wait_for(fut, timeout)
+            except BaseException as e:
+                if fut.done() and not fut.cancelled():
+                    self.release()  # Слот успели выдать — возвращаем
+                if isinstance(e, asyncio.TimeoutError):
+                    raise SlotTimeout() from None
+                raise
+            finally:
+                st.waiting -= 1
+        wait = time.perf_counter() - started
+        st.waits.append(wait)
+        return wait
+
+    def free(self) -> bool:
+        # Слот можно занять сразу, никого не обгоняя
+        return self.busy < self.workers and not self.waiters
+
+    def release(self):
+        # Слот переходит первому живому ожидающему с наивысшим приоритетом
+        while self.waiters:
+            _, _, fut = heapq.heappop(self.waiters)
+            if not fut.done():
+                fut.set_result(None)
+                return
+        self.busy -= 1
+
+    def _prune(self, now: float):
+        while self.bg_calls and now - self.bg_calls[0] > 60:
+            self.bg_calls.popleft()
+        while self.bg_tokens and now - self.bg_tokens[0][0] > 60:
+            self.bg_tokens.popleft()
+
+    def admit(self, priority: int) -> bool:
+        if priority != BACKGROUND:
+            return True
+        now = time.monotonic()
+        self._prune(now)
+        if len(self.bg_calls) >= self.bg_calls_per_min or sum(n for _, n in self.bg_tokens) >= self.bg_tokens_per_min:
+            return False
+        self.bg_calls.append(now)
+        return True
+
+    def record(self, priority: int, latency: float, tokens: int = 0):
+        st = self.classes[priority]
+        st.served += 1
+        st.latencies.append(latency)
+        if priority == BACKGROUND and tokens:
+            self.bg_tokens.append((time.monotonic(), tokens))
+
+    def record_overflow(self, priority: int, degraded: bool):
+        st = self.classes[priority]
+        if degraded:
+            st.degraded += 1
+        else:
+            st.shed += 1
+
+    def stats(self):
+        def pct(xs, p):
+            xs = sorted(xs)
+            return round(xs[min(len(xs) - 1, int(len(xs) * p))] * 1000, 1) if xs else 0.0
+        self._prune(time.monotonic())
+        out = {
+            "workers": self.workers,
+            "busy": self.busy,
+            "bg_calls_last_min": len(self.bg_calls),
+            "bg_tokens_last_min": sum(n for _, n in self.bg_tokens),
+        }
+        for p, st in self.classes.items():
+            out[PRIORITY_NAMES[p]] = {
+                "served": st.served,
+                "waiting": st.waiting,
+                "shed": st.shed,
+                "degraded": st.degraded,
+                "wait_p50_ms": pct(st.waits, 0.5),
+                "wait_p99_ms": pct(st.waits, 0.99),
+                "latency_p50_ms": pct(st.latencies, 0.5),
+                "latency_p99_ms": pct(st.latencies, 0.99),
+            }
+        return out
@@ -0,0 +1,218 @@
+import asyncio
+import json
+import logging
+import os
+from collections import deque
+from urllib.parse import urlparse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+BUS_URL = os.environ.get('BUS_URL', '')  # '' — внутри процесса; redis://host:6379 или unix:///tmp/city-bus.sock
+BUS_PREFIX = os.environ.get('BUS_PREFIX', 'city:')  # Префикс каналов, чтобы делить один Redis
+BUS_MAX_PENDING = int(os.environ.get('BUS_MAX_PENDING', 10000))  # Неотправленных публикаций, пока нет связи
+
+def dumps(message) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(message)
+    return json.dumps(message, ensure_ascii=False).encode()
+
+def loads(data: bytes):
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+def encode_command(*args) -> bytes:
+    # RESP: массив bulk-строк
+    out = [b'*%d\r\n' % len(args)]
+    for arg in args:
+        if isinstance(arg, str):
+            arg = arg.encode()
+        out.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+    return b''.join(out)
+
+async def read_reply(reader):
+    line = await reader.readline()
+    if not line:
+        raise ConnectionError("соединение закрыто")
+    kind, rest = line[:1], line[1:-2]
+    if kind == b'+':
+        return rest
+    if kind == b'-':
+        raise RuntimeError(rest.decode())
+    if kind == b':':
+        return int(rest)
+    if kind == b'$':
+        n = int(rest)
+        if n < 0:
+            return None
+        data = await reader.readexactly(n + 2)
+        return data[:-2]
+    if kind == b'*':
+        n = int(rest)
+        return None if n < 0 else [await read_reply(reader) for _ in range(n)]
+    raise RuntimeError(f"неизвестный ответ: {line!r}")
+
+class LocalBus:
+    """Шина внутри одного процесса: publish сразу вызывает подписчиков."""
+    local = True
+
+    def __init__(self):
+        self.handlers = {}  # канал -> [async handler(message)]
+        self.published = 0
+
+    def subscribe(self, channel: str, handler):
+        self.handlers.setdefault(channel, []).append(handler)
+
+    async def publish(self, channel: str, message: dict):
+        self.published += 1
+        for handler in self.handlers.get(channel, ()):
+            await handler(message)
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    def stats(self):
+        return {"backend": "local", "published": self.published}
+
+class RedisBus:
+    """Pub/sub по протоколу Redis (RESP): настоящий Redis или app/bus_server.py на локальном сокете.
+
+    Публикации конвейером уходят из отдельной задачи-писателя, поэтому publish не ждёт сети.
+    Каждый воркер получает и свои собственные публикации — обработка одинакова для всех процессов.
+    """
+    local = False
+
+    def __init__(self, url: str, prefix: str = BUS_PREFIX, max_pending: int = BUS_MAX_PENDING):
+        self.url = urlparse(url)
+        self.prefix = prefix
+        self.max_pending = max_pending
+        self.handlers = {}
+        self.outbox = deque()
+        self.ready = asyncio.Event()
+        self.subscribed = asyncio.Event()
+        self.tasks = []
+        self.published = 0
+        self.received = 0
+        self.dropped = 0
+        self.reconnects = 0
+
+    async def _open(self):
+        if self.url.scheme == 'unix':
+            reader, writer = await asyncio.open_unix_connection(self.url.path)
+        else:
+            reader, writer = await asyncio.open_connection(self.url.hostname or '127.0.0.1', self.url.port or 6379)
+        if self.url.password:
+            writer.write(encode_command('AUTH', self.url.password))
+            await writer.drain()
+            await read_reply(reader)
+        return reader, writer
+
+    def subscribe(self, channel: str, handler):
+        # Подписки задаются до start()
+        self.handlers.setdefault(channel, []).append(handler)
+
+    async def publish(self, channel: str, message: dict):
+        if len(self.outbox) >= self.max_pending:
+            self.outbox.popleft()
+            self.dropped += 1
+        self.outbox.append(encode_command('PUBLISH', self.prefix + channel, dumps(message)))
+        self.published += 1
+        self.ready.set()
+
+    async def _discard_replies(self, reader):
+        while True:
+            await read_reply(reader)
+
+    async def _publisher(self):
+        while True:
+            writer = None
+            replies = None
+            try:
+                reader, writer = await self._open()
+                replies = asyncio.create_task(self._discard_replies(reader))
+                while True:
+                    await self.ready.wait()
+                    self.ready.clear()
+                    if replies.done():
+                        replies.result()  # Пробрасываем обрыв соединения
+                    batch = []
+                    while self.outbox:
+                        batch.append(self.outbox.popleft())
+                    writer.write(b''.join(batch))
+                    await writer.drain()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.reconnects += 1
+                logger.warning(f"Шина: публикация прервана ({e}), переподключение")
+                await asyncio.sleep(1)
+            finally:
+                if replies:
+                    replies.cancel()
+                if writer:
+                    writer.close()
+
+    async def _subscriber(self):
+        while True:
+            writer = None
+            try:
+                reader, writer = await self._open()
+                writer.write(encode_command('SUBSCRIBE', *[self.prefix + ch for ch in self.handlers]))
+                await writer.drain()
+                while True:
+                    reply = await read_reply(reader)
+                    if not isinstance(reply, list):
+                        continue
+                    if reply[0] == b'subscribe':
+                        self.subscribed.set()
+                        continue
+                    if reply[0] != b'message':
+                        continue
+                    self.received += 1
+                    channel = reply[1].decode()[len(self.prefix):]
+                    message = loads(reply[2])
+                    for handler in self.handlers.get(channel, ()):
+                        try:
+                            await handler(message)
+                        except Exception as e:
+                            logger.error(f"Шина: ошибка обработчика {channel}: {e}")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.reconnects += 1
+                logger.warning(f"Шина: подписка прервана ({e}), переподключение")
+                await asyncio.sleep(1)
+            finally:
+                if writer:
+                    writer.close()
+
+    async def start(self):
+        self.tasks = [asyncio.create_task(self._subscriber()), asyncio.create_task(self._publisher())]
+        try:
+            await asyncio.wait_for(self.subscribed.wait(), timeout=10)
+        except asyncio.TimeoutError:
+            logger.error(f"Шина {self.url.geturl()} недоступна, продолжаем попытки в фоне")
+
+    async def stop(self):
+        if self.outbox:
+            await asyncio.sleep(0.1)  # Даём писателю отправить хвост
+        for t in self.tasks:
+            t.cancel()
+        self.tasks = []
+
+    def stats(self):
+        return {"backend": self.url.scheme, "published": self.published, "received": self.received,
+                "pending": len(self.outbox), "dropped": self.dropped, "reconnects": self.reconnects}
+
+def make_bus(url: str = BUS_URL):
+    if not url:
+        return LocalBus()
+    if urlparse(url).scheme in ('redis', 'unix'):
+        return RedisBus(url)
+    raise ValueError(f"Неизвестная шина: {url}")
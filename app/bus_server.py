@@ -0,0 +1,96 @@
+"""Минимальный pub/sub-хаб с протоколом Redis (SUBSCRIBE/PUBLISH/PING) для нескольких воркеров на одной машине.
+
+    python -m app.bus_server --unix /tmp/city-bus.sock
+    BUS_URL=unix:///tmp/city-bus.sock uvicorn app.server:app --workers 4
+
+Годится и как замена Redis в тестах; в проде можно указать BUS_URL=redis://host:6379.
+"""
+import argparse
+import asyncio
+import logging
+import os
+from .bus import read_reply
+
+logger = logging.getLogger(__name__)
+
+def _array(*items) -> bytes:
+    out = [b'*%d\r\n' % len(items)]
+    for item in items:
+        if isinstance(item, int):
+            out.append(b':%d\r\n' % item)
+        else:
+            out.append(b'$%d\r\n%s\r\n' % (len(item), item))
+    return b''.join(out)
+
+class BusServer:
+    def __init__(self):
+        self.channels = {}  # канал -> {writer}
+        self.server = None
+
+    async def handle(self, reader, writer):
+        subs = set()
+        try:
+            while True:
+                try:
+                    cmd = await read_reply(reader)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    return
+                if not isinstance(cmd, list) or not cmd:
+                    writer.write(b'-ERR protocol error\r\n')
+                    continue
+                name = cmd[0].upper()
+                if name == b'PUBLISH' and len(cmd) == 3:
+                    targets = self.channels.get(cmd[1], ())
+                    frame = _array(b'message', cmd[1], cmd[2])
+                    for w in list(targets):
+                        w.write(frame)
+                    writer.write(b':%d\r\n' % len(targets))
+                elif name == b'SUBSCRIBE':
+                    for ch in cmd[1:]:
+                        self.channels.setdefault(ch, set()).add(writer)
+                        subs.add(ch)
+                        writer.write(_array(b'subscribe', ch, len(subs)))
+                elif name == b'PING':
+                    writer.write(b'+PONG\r\n')
+                elif name == b'AUTH':
+                    writer.write(b'+OK\r\n')
+                else:
+                    writer.write(b'-ERR unknown command\r\n')
+                await writer.drain()
+        finally:
+            for ch in subs:
+                self.channels.get(ch, set()).discard(writer)
+            writer.close()
+
+    async def start(self, unix: str = None, host: str = '127.0.0.1', port: int = 6390):
+        if unix:
+            if os.path.exists(unix):
+                os.unlink(unix)  # Сокет от прошлого запуска
+            self.server = await asyncio.start_unix_server(self.handle, path=unix)
+        else:
+            self.server = await asyncio.start_server(self.handle, host, port)
+        return self.server
+
+    async def stop(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+
+async def serve(unix, host, port):
+    hub = BusServer()
+    server = await hub.start(unix, host, port)
+    logger.info(f"Шина слушает {unix or f'{host}:{port}'}")
+    async with server:
+        await server.serve_forever()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--unix', default=None, help='Путь к unix-сокету')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6390)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(serve(args.unix, args.host, args.port))
+
+if __name__ == '__main__':
+    main()
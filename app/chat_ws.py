@@ -1,29 +1,338 @@
 from fastapi import WebSocket
+import asyncio
 import json
-from typing import Dict, List
+import logging
+import os
+import time
+from collections import deque
+from typing import Dict
+from .metrics import registry, topic_label, WS_BROADCAST, WS_SEND
 
-class ConnectionManager:
+try:
+    import orjson  # Быстрый JSON, если установлен
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack  # Бинарный протокол по выбору клиента
+except ImportError:
+    msgpack = None
+
+logger = logging.getLogger(__name__)
+
+WS_QUEUE_SIZE = int(os.environ.get('WS_QUEUE_SIZE', 100))  # Кадров в очереди на соединение
+WS_OVERFLOW_POLICY = os.environ.get('WS_OVERFLOW_POLICY', 'drop_oldest')  # drop_oldest | coalesce | disconnect
+WS_HELD_QUEUE_SIZE = int(os.environ.get('WS_HELD_QUEUE_SIZE', 1000))  # Лимит очереди, пока идёт догоняющая выдача (held)
+OVERFLOW_POLICIES = ('drop_oldest', 'coalesce', 'disconnect')
+MSGPACK_SUBPROTOCOL = 'msgpack'
+
+def encode(message: dict) -> str:
+    if orjson is not None:
+        try:
+            return orjson.dumps(message).decode()
+        except TypeError:  # Целые шире 64 бит и прочее, чего orjson не умеет, — стандартному json
+            pass
+    return json.dumps(message, ensure_ascii=False)
+
+def _compact_npc(fields: dict, location_ids: dict) -> dict:
+    loc = fields.get('location')
+    if loc in location_ids:
+        return {**fields, 'location': location_ids[loc]}
+    return fields
+
+def compact(message: dict, location_ids: dict) -> dict:
+    # Для бинарных клиентов: локации — числовые id (таблица приходит кадром locations), ключи npcs — числа
+    kind, data = message.get('type'), message.get('data')
+    if not isinstance(data, dict):
+        return message
+    if kind in ('map_delta', 'map_snapshot') and 'npcs' in data:
+        npcs = {int(key): _compact_npc(fields, location_ids) for key, fields in data['npcs'].items()}
+        return {**message, 'data': {**data, 'npcs': npcs}}
+    if kind == 'state_update' and isinstance(data.get('state'), dict):
+        return {**message, 'data': {**data, 'state': _compact_npc(data['state'], location_ids)}}
+    return message
+
+def pack(message: dict, location_ids: dict) -> bytes:
+    return msgpack.packb(compact(message, location_ids), use_bin_type=True)
+
+def negotiate(ws: WebSocket):
+    # Sec-WebSocket-Protocol: msgpack или ?encoding=msgpack; без msgpack в окружении — JSON (по умолчанию)
+    offered = [p.strip() for p in ws.headers.get('sec-websocket-protocol', '').split(',')]
+    if msgpack is not None and (MSGPACK_SUBPROTOCOL in offered or ws.query_params.get('encoding') == 'msgpack'):
+        return 'msgpack', MSGPACK_SUBPROTOCOL if MSGPACK_SUBPROTOCOL in offered else None
+    return 'json', None
+
+def coalesce_key(message: dict):
+    # Кадры об одной и той же сущности (map_update/state_update по id) можно схлопывать
+    data = message.get('data')
+    if isinstance(data, dict) and 'id' in data:
+        return (message.get('type'), data['id'])
+    return None
+
+class TopicStats:
     def __init__(self):
-        self.topics: Dict[str, List[WebSocket]] = {}
+        self.broadcasts = 0
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.disconnected = 0
+        self.max_queue_depth = 0
+        self.bytes_sent = {}  # кодировка -> байт
+
+    def merge(self, other: 'TopicStats'):
+        for name in ('broadcasts', 'sent', 'dropped', 'coalesced', 'disconnected'):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        self.max_queue_depth = max(self.max_queue_depth, other.max_queue_depth)
+        for encoding, n in other.bytes_sent.items():
+            self.bytes_sent[encoding] = self.bytes_sent.get(encoding, 0) + n
+
+    def as_dict(self, conns: dict) -> dict:
+        return {
+            "subscribers": len(conns),
+            "queue_depth": sum(len(c.queue) for c in conns.values()),
+            "max_queue_depth": self.max_queue_depth,
+            "broadcasts": self.broadcasts,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+            "disconnected": self.disconnected,
+            "bytes_sent": dict(self.bytes_sent),
+        }
+
+class Connection:
+    """Сокет + ограниченная очередь исходящих кадров + задача-писатель."""
+
+    def __init__(self, manager, topic: str, ws: WebSocket, meta: dict = None, held: bool = False, encoding: str = 'json'):
+        self.manager = manager
+        self.topic = topic
+        self.ws = ws
+        self.encoding = encoding  # json — текстовые кадры, msgpack — бинарные
+        self.meta = meta or {}  # Параметры подписки (например, регион карты)
+        self.queue = deque()  # [key, frame, droppable]
+        self.pending = {}  # key -> элемент очереди, для coalesce
+        self.ready = asyncio.Event()
+        self.released = asyncio.Event()  # Пока не выставлен, живые кадры только копятся (догоняющая выдача)
+        if not held:
+            self.released.set()
+        self.held_dropped = 0  # Вытеснено за время удержания: о дыре скажет тот, кто отпускает (release)
+        self.backlog = 0  # Накоплено за удержание и ещё не отправлено: в обычный лимит не входит
+        self.closed = False
+        self.writer = asyncio.create_task(self._write_loop())
+
+    def offer(self, frame: str, key=None, droppable: bool = True):
+        stats = self.manager.stats_for(self.topic)
+        policy = self.manager.policy
+        if policy == 'coalesce' and key is not None and key in self.pending:
+            self.pending[key][1] = frame
+            stats.coalesced += 1
+            return
+        held = not self.released.is_set()
+        if len(self.queue) >= (WS_HELD_QUEUE_SIZE if held else self.manager.queue_size + self.backlog):
+            # Вытесняем самый старый droppable-кадр; служебные (locations, map_snapshot, ответы) не трогаем,
+            # но в лимит они входят: если очередь забита ими одними — клиент не успевает, отключаем.
+            # Во время удержания не отключаем: в сокет ещё пишет догоняющая выдача
+            victim = None if policy == 'disconnect' and not held else next((i for i, it in enumerate(self.queue) if it[2]), None)
+            if victim is None and held:
+                self.held_dropped += 1
+                stats.dropped += 1
+                return
+            if victim is None:
+                stats.dropped += 1
+                self.manager.drop(self, reason='slow consumer')
+                return
+            old_key = self.queue[victim][0]
+            del self.queue[victim]
+            if old_key is not None:
+                self.pending.pop(old_key, None)
+            stats.dropped += 1
+            self.held_dropped += held
+        item = [key, frame, droppable]
+        self.queue.append(item)
+        if key is not None:
+            self.pending[key] = item
+        stats.max_queue_depth = max(stats.max_queue_depth, len(self.queue))
+        self.ready.set()
+
+    async def _write_loop(self):
+        try:
+            await self.released.wait()
+            while True:
+                await self.ready.wait()
+                self.ready.clear()
+                while self.queue:
+                    item = self.queue.popleft()
+                    if item[0] is not None and self.pending.get(item[0]) is item:
+                        del self.pending[item[0]]
+                    started = time.perf_counter()
+                    await self.send(item[1])
+                    if self.backlog:
+                        self.backlog -= 1
+                    WS_SEND.observe(time.perf_counter() - started, topic_label(self.topic))
+                    self.manager.stats_for(self.topic).sent += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.debug(f"WS {self.topic}: сокет отвалился ({e})")
+            self.manager.drop(self, reason='send failed')
+
+    def encode(self, message: dict):
+        return self.manager.encoder(self.encoding)(message)
+
+    async def send(self, frame):
+        # Мимо очереди; снаружи — только пока писатель на паузе (held)
+        if isinstance(frame, bytes):
+            await self.ws.send_bytes(frame)
+        else:
+            await self.ws.send_text(frame)
+        sent = self.manager.stats_for(self.topic).bytes_sent
+        sent[self.encoding] = sent.get(self.encoding, 0) + len(frame)
 
-    async def connect(self, topic: str, ws: WebSocket):
-        await ws.accept()
-        self.topics.setdefault(topic, []).append(ws)
+    async def receive(self) -> dict:
+        # Входящие кадры — в кодировке соединения; битый кадр — пустое сообщение
+        try:
+            if self.encoding == 'msgpack':
+                msg = msgpack.unpackb(await self.ws.receive_bytes(), raw=False)
+            else:
+                msg = json.loads(await self.ws.receive_text())
+        except (ValueError, KeyError):  # KeyError — кадр не того типа (текст вместо байтов)
+            msg = {}
+        return msg if isinstance(msg, dict) else {}
+
+    def first_key(self):
+        return next((it[0] for it in self.queue if it[0] is not None), None)
+
+    def release(self, first=None):
+        # first — кадр, который уйдёт раньше накопленного (например, news_gap)
+        if first is not None:
+            self.queue.appendleft([None, first, False])
+            self.ready.set()
+        self.backlog = len(self.queue)
+        self.released.set()
+
+    def close(self):
+        self.closed = True
+        self.writer.cancel()
+
+class ConnectionManager:
+    def __init__(self, queue_size: int = WS_QUEUE_SIZE, policy: str = WS_OVERFLOW_POLICY):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Неизвестная политика переполнения: {policy}")
+        self.queue_size = queue_size
+        self.policy = policy
+        self.topics: Dict[str, Dict[WebSocket, Connection]] = {}
+        self.topic_stats: Dict[str, TopicStats] = {}  # Только топики с подписчиками
+        self.closed_stats: Dict[str, TopicStats] = {}  # topic_label -> итог по опустевшим топикам: счётчики не откатываются
+        self.bus = None  # Общая шина воркеров; None — рассылка только в своём процессе
+        self.location_ids = {}  # имя локации -> id для бинарных кадров
+
+    def set_locations(self, locations):
+        self.location_ids = {loc.name: loc.id for loc in locations}
+
+    def encoder(self, encoding: str):
+        if encoding == 'msgpack':
+            return lambda message: pack(message, self.location_ids)
+        return encode
+
+    def attach(self, bus):
+        # Кадры из publish() любого воркера уходят подписчикам во всех воркерах
+        self.bus = bus
+        bus.subscribe('frames', self._on_frame)
+
+    async def _on_frame(self, msg: dict):
+        await self.broadcast(msg['topic'], msg['message'])
+
+    async def publish(self, topic: str, message: dict):
+        # Как broadcast, но через шину: подписчики топика могут сидеть в других воркерах
+        if self.bus is None:
+            await self.broadcast(topic, message)
+        else:
+            await self.bus.publish('frames', {"topic": topic, "message": message})
+
+    def stats_for(self, topic: str) -> TopicStats:
+        # Топики задаёт клиент (/ws/<что угодно>, npc_<любой id>): без подписчиков — в общий итог по метке
+        if topic in self.topics:
+            return self.topic_stats.setdefault(topic, TopicStats())
+        return self.closed_stats.setdefault(topic_label(topic), TopicStats())
+
+    async def connect(self, topic: str, ws: WebSocket, held: bool = False, **meta) -> Connection:
+        # held=True: писатель ждёт conn.release(), а до этого вызывающий сам шлёт в сокет пропущенное
+        encoding, subprotocol = negotiate(ws)
+        await ws.accept(subprotocol=subprotocol)
+        conn = self.topics.setdefault(topic, {})[ws] = Connection(self, topic, ws, meta, held, encoding)
+        if encoding == 'msgpack':  # Таблица для числовых location
+            conn.offer(conn.encode({"type": "locations", "data": {i: name for name, i in self.location_ids.items()}}), droppable=False)
+        return conn
 
     def disconnect(self, topic: str, ws: WebSocket):
-        if topic in self.topics and ws in self.topics[topic]:
-            self.topics[topic].remove(ws)
+        conns = self.topics.get(topic)
+        if conns is None or ws not in conns:
+            return
+        conns.pop(ws).close()
+        if not conns:
+            del self.topics[topic]
+            st = self.topic_stats.pop(topic, None)
+            if st is not None:
+                self.stats_for(topic).merge(st)
+
+    def drop(self, conn: Connection, reason: str = ''):
+        # Удаляем мёртвого/медленного подписчика, чтобы списки не росли бесконечно
+        if conn.closed:
+            return
+        self.stats_for(conn.topic).disconnected += 1
+        self.disconnect(conn.topic, conn.ws)
+        if reason == 'slow consumer':
+            asyncio.create_task(self._close_ws(conn.ws))
+
+    async def _close_ws(self, ws: WebSocket):
+        try:
+            await ws.close(code=1013)  # Try again later
+        except Exception:
+            pass
 
     async def send_personal(self, ws: WebSocket, message: dict):
-        await ws.send_text(json.dumps(message, ensure_ascii=False))
+        for conns in self.topics.values():
+            if ws in conns:
+                conns[ws].offer(conns[ws].encode(message), droppable=False)
+                return
+        await ws.send_text(encode(message))
 
-    async def broadcast(self, topic: str, message: dict):
-        if topic not in self.topics:
+    async def broadcast(self, topic: str, message: dict, where=None):
+        # where(meta) -> bool: рассылка только части подписчиков топика
+        conns = self.topics.get(topic)
+        if not conns:
+            return
+        targets = [c for c in conns.values() if where is None or where(c.meta)]
+        if not targets:
             return
-        for ws in list(self.topics[topic]):
-            try:
-                await ws.send_text(json.dumps(message, ensure_ascii=False))
-            except Exception:
-                pass
+        started = time.perf_counter()
+        frames = {}  # Сериализуем один раз на кодировку, а не на подписчика
+        key = coalesce_key(message)
+        self.stats_for(topic).broadcasts += 1
+        for conn in targets:
+            frame = frames.get(conn.encoding)
+            if frame is None:
+                frame = frames[conn.encoding] = self.encoder(conn.encoding)(message)
+            conn.offer(frame, key)
+        WS_BROADCAST.observe(time.perf_counter() - started, topic_label(topic))
+
+    def stats(self):
+        out = {topic: st.as_dict(self.topics.get(topic, {})) for topic, st in self.topic_stats.items()}
+        out.update((f"closed:{label}", st.as_dict({})) for label, st in self.closed_stats.items())
+        return out
+
+manager = ConnectionManager()
+
+def _by_topic(value, closed=None):
+    # closed(TopicStats) — вклад опустевших топиков, чтобы счётчики по метке не убывали
+    out = {}
+    for topic in manager.topics:
+        label = topic_label(topic)
+        out[label] = out.get(label, 0) + value(topic)
+    if closed is not None:
+        for label, st in manager.closed_stats.items():
+            out[label] = out.get(label, 0) + closed(st)
+    return out
 
-manager = ConnectionManager()
\ No newline at end of file
+registry.callback('ws_subscribers', 'Подписчиков на топике', lambda: _by_topic(lambda t: len(manager.topics.get(t, {}))), ('topic',))
+registry.callback('ws_queue_depth', 'Кадров в очередях подписчиков', lambda: _by_topic(lambda t: sum(len(c.queue) for c in manager.topics.get(t, {}).values())), ('topic',))
+registry.callback('ws_frames_dropped_total', 'Кадров выброшено из-за переполнения очереди', lambda: _by_topic(lambda t: manager.stats_for(t).dropped, lambda st: st.dropped), ('topic',), kind='counter')
@@ -0,0 +1,80 @@
+import asyncio
+import heapq
+
+class RealClock:
+    """Время event loop: обычный режим сервера."""
+
+    def now(self) -> float:
+        return asyncio.get_running_loop().time()
+
+    async def sleep(self, seconds: float):
+        await asyncio.sleep(seconds)
+
+    def spawn(self, coro) -> asyncio.Task:
+        return asyncio.create_task(coro)
+
+class VirtualClock:
+    """Виртуальное время для прогона без сервера: sleep() не ждёт по-настоящему.
+
+    Часы знают своих участников (задачи из spawn) и переводятся к ближайшему пробуждению, только когда
+    все участники спят на часах. Пока кто-то ждёт БД или другой ввод-вывод, время стоит.
+    """
+
+    def __init__(self, start: float = 0.0):
+        self.time = start
+        self.sleepers = []  # (when, seq, future)
+        self.seq = 0
+        self.alive = 0
+        self.idle = asyncio.Event()
+        self.advances = 0
+
+    def now(self) -> float:
+        return self.time
+
+    async def sleep(self, seconds: float):
+        fut = asyncio.get_running_loop().create_future()
+        self.seq += 1
+        heapq.heappush(self.sleepers, (self.time + max(0.0, seconds), self.seq, fut))
+        self._check_idle()
+        try:
+            await fut
+        except asyncio.CancelledError:
+            fut.cancel()  # Отменённых выкидывает run()
+            self._check_idle()
+            raise
+
+    def spawn(self, coro) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self.alive += 1
+        task.add_done_callback(self._done)
+        return task
+
+    def _done(self, _):
+        self.alive -= 1
+        self._check_idle()
+
+    def _waiting(self) -> int:
+        return sum(1 for _, _, fut in self.sleepers if not fut.done())
+
+    def _check_idle(self):
+        if self._waiting() >= self.alive:
+            self.idle.set()
+
+    async def run(self, until: float):
+        # Крутит часы до until (или пока есть участники); пробуждает всех, кому пора, пачкой
+        while self.alive:
+            await self.idle.wait()
+            self.idle.clear()
+            while self.sleepers and self.sleepers[0][2].done():
+                heapq.heappop(self.sleepers)
+            if self._waiting() < self.alive:  # Кто-то проснулся сам (отмена) — ждём, пока снова все уснут
+                continue
+            if not self.sleepers or self.sleepers[0][0] > until:
+                self.time = until
+                return
+            self.time = self.sleepers[0][0]
+            self.advances += 1
+            while self.sleepers and self.sleepers[0][0] <= self.time:
+                _, _, fut = heapq.heappop(self.sleepers)
+                if not fut.done():
+                    fut.set_result(None)
@@ -0,0 +1,100 @@
+import asyncio
+import logging
+import os
+from contextlib import asynccontextmanager
+from .bus import make_bus
+from .db import BASE_DIR
+
+try:
+    import fcntl
+except ImportError:  # Windows: без блокировок, один воркер
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+LEADER_LOCK = os.environ.get('LEADER_LOCK', os.path.join(BASE_DIR, 'leader.lock'))  # Файл блокировки ведущего воркера
+LEADER_RETRY = float(os.environ.get('LEADER_RETRY', 2))  # Как часто ведомый пробует стать ведущим
+
+class FileLock:
+    """flock на файле: ОС снимает блокировку, если процесс умер, — ведомый подхватит симуляцию."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.fd = None
+
+    def try_acquire(self, blocking: bool = False) -> bool:
+        if fcntl is None:
+            return True
+        if self.fd is None:
+            self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            return False
+        os.ftruncate(self.fd, 0)
+        os.write(self.fd, str(os.getpid()).encode())
+        return True
+
+    def release(self):
+        if self.fd is None:
+            return
+        if fcntl is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        self.fd = None
+
+class Cluster:
+    """Несколько воркеров uvicorn: общая шина событий и один ведущий, который крутит симуляцию."""
+
+    def __init__(self, bus, lock_path: str = LEADER_LOCK, retry: float = LEADER_RETRY):
+        self.bus = bus
+        self.lock = FileLock(lock_path)
+        self.init_lock_path = lock_path + '.init'
+        self.retry = retry
+        self.is_leader = False
+        self.on_elected = None
+        self.task = None
+
+    @asynccontextmanager
+    async def init_lock(self):
+        # create_all/миграции/засев по очереди, а не наперегонки из всех воркеров
+        lock = FileLock(self.init_lock_path)
+        await asyncio.to_thread(lock.try_acquire, True)
+        try:
+            yield
+        finally:
+            lock.release()
+
+    async def start(self, on_elected):
+        self.on_elected = on_elected
+        await self.bus.start()
+        if self.lock.try_acquire():
+            await self._elected(promoted=False)
+        else:
+            logger.info(f"Воркер {os.getpid()}: ведомый, симуляция в другом процессе")
+            self.task = asyncio.create_task(self._campaign())
+
+    async def _campaign(self):
+        while not self.is_leader:
+            await asyncio.sleep(self.retry)
+            if self.lock.try_acquire():
+                await self._elected(promoted=True)
+
+    async def _elected(self, promoted: bool):
+        # on_elected(promoted): promoted=True — воркер был ведомым, и его копия мира могла отстать
+        self.is_leader = True
+        logger.info(f"Воркер {os.getpid()}: ведущий, запускаю симуляцию")
+        await self.on_elected(promoted)
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        await self.bus.stop()
+        self.lock.release()
+        self.is_leader = False
+
+    def stats(self):
+        return {"pid": os.getpid(), "leader": self.is_leader, "bus": self.bus.stats()}
+
+cluster = Cluster(make_bus())
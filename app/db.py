@@ -1,21 +1,53 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy import event, select
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.orm import declarative_base
 import os
+from .metrics import instrument_engine
 
 BASE_DIR = os.path.dirname(__file__)
 DB_FILE = os.path.join(BASE_DIR, 'city.db')
-SQLITE_URL = os.environ.get('SQLITE_URL', f"sqlite:///{DB_FILE}")
+SQLITE_URL = os.environ.get('SQLITE_URL', f"sqlite+aiosqlite:///{DB_FILE}")
+if SQLITE_URL.startswith('sqlite:///'):  # Старые URL без драйвера -> aiosqlite
+    SQLITE_URL = SQLITE_URL.replace('sqlite:///', 'sqlite+aiosqlite:///', 1)
 
-engine = create_engine(SQLITE_URL, connect_args={"check_same_thread": False})
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 30))
+
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",  # Читатели не блокируют писателя
+    "synchronous": "NORMAL",  # В WAL безопасно и заметно быстрее FULL
+    "busy_timeout": 5000,
+    "cache_size": -20000,  # ~20 МБ
+    "temp_store": "MEMORY",
+}
+
+_pool_args = {} if ':memory:' in SQLITE_URL else {
+    "pool_size": DB_POOL_SIZE,
+    "max_overflow": DB_MAX_OVERFLOW,
+    "pool_timeout": DB_POOL_TIMEOUT,
+}
+engine = create_async_engine(SQLITE_URL, **_pool_args)
+AsyncSessionLocal = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
 Base = declarative_base()
+instrument_engine(engine)  # Время запросов/коммитов для /metrics
+
+@event.listens_for(engine.sync_engine, "connect")
+def _set_sqlite_pragmas(dbapi_conn, _):
+    cur = dbapi_conn.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        cur.execute(f"PRAGMA {name}={value}")
+    cur.close()
 
-def init_db():
+async def init_db():
     from . import models
-    Base.metadata.create_all(bind=engine)
-    db = SessionLocal()
-    try:
-        if not db.query(models.Location).first():
+    from .migrations import migrate_npc_state, migrate_indexes
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(migrate_npc_state)
+        await conn.run_sync(migrate_indexes)
+    async with AsyncSessionLocal() as db:
+        if not (await db.execute(select(models.Location).limit(1))).scalar():
             locations = [
                 models.Location(name="home", x_min=0, x_max=200, y_min=0, y_max=200),
                 models.Location(name="shop", x_min=200, x_max=400, y_min=200, y_max=400),
@@ -24,9 +56,7 @@ def init_db():
                 models.Location(name="mayor_office", x_min=0, x_max=200, y_min=200, y_max=400),  # Добавил для выборов
             ]
             db.add_all(locations)
-            db.commit()
-        if not db.query(models.Weather).first():
+            await db.commit()
+        if not (await db.execute(select(models.Weather).limit(1))).scalar():
             db.add(models.Weather(current="sunny"))
-            db.commit()
-    finally:
-        db.close()
\ No newline at end of file
+            await db.commit()
@@ -0,0 +1,154 @@
+"""Прогон симуляции без сервера: виртуальные часы, фиксированный seed, ответы NPC без OpenAI.
+
+    python -m app.headless --hours 24 --npcs 500 --seed 1
+    python -m app.headless --hours 6 --profile
+
+Тики, погода и выборы идут так быстро, как позволяет CPU; write-behind сбрасывается по тем же
+виртуальным часам. Отчёт: симулированных секунд за секунду реального времени и записей в БД
+за симулированный час. Одинаковый seed даёт одинаковый мир (см. fingerprint).
+"""
+import argparse
+import asyncio
+import cProfile
+import hashlib
+import io
+import json
+import os
+import pstats
+import random
+import tempfile
+import time
+from collections import Counter
+
+REPLIES = [
+    "Всё спокойно, работаю потихоньку.",
+    "Рад тебя видеть! Это дружба.",
+    "Не трогай меня, во мне злость.",
+    "Слышал новости про мэра?",
+    "Погода сегодня странная.",
+    "Открою небольшую лавку у парка.",
+    "Заходи вечером, поговорим.",
+]
+
+class Responder:
+    """Детерминированная замена generate_reply: ответ зависит только от промпта и seed."""
+
+    def __init__(self, seed: int):
+        self.seed = seed
+        self.calls = 0
+
+    async def __call__(self, system_prompt, history, user_message, priority=None, fallback=None):
+        self.calls += 1
+        digest = hashlib.sha256(f"{self.seed}|{system_prompt}|{user_message}".encode()).digest()
+        return REPLIES[digest[0] % len(REPLIES)]
+
+def db_statements(hist) -> dict:
+    # Сколько SQL-запросов каждого вида уже видела гистограмма DB_QUERY
+    return {labels[0]: sum(series[:-1]) for labels, series in hist.series.items()}
+
+def fingerprint(world) -> str:
+    state = sorted((n.id, n.money, n.location, n.business, round(n.x or 0, 6), round(n.y or 0, 6)) for n in world.npcs.values())
+    rels = sorted((a, b, k) for a, others in world.relations.items() for b, k in others.items())
+    return hashlib.sha256(json.dumps([state, rels, world.weather.current], ensure_ascii=False).encode()).hexdigest()[:16]
+
+async def run(args) -> dict:
+    # Модули приложения читают SQLITE_URL, NPC_COUNT и ключ OpenAI при импорте — импортируем после настройки окружения
+    from .clock import VirtualClock
+    from .db import init_db, engine
+    from .metrics import DB_QUERY, DB_COMMIT
+    from .npc_manager import NPCManager, NPC_TICK_INTERVAL
+    from .world import world
+
+    clock = VirtualClock()
+    responder = Responder(args.seed)
+    published = Counter()
+
+    async def broadcaster(topic, payload):
+        published[topic.split(':')[0]] += 1
+
+    async def flush_loop():
+        # write-behind по виртуальным часам: раз в max_flush_lag или сразу, когда набралось flush_dirty записей
+        last = clock.now()
+        while True:
+            await clock.sleep(NPC_TICK_INTERVAL)
+            if world.wakeup.is_set() or clock.now() - last >= world.max_flush_lag:
+                world.wakeup.clear()
+                last = clock.now()
+                await world.flush()
+
+    manager = NPCManager(broadcaster, clock=clock, rng=random.Random(args.seed), responder=responder, seed=args.seed)
+    await init_db()
+    await manager.seed()
+    await world.load()
+    await manager.start()
+    flusher = clock.spawn(flush_loop())
+    statements, commits = db_statements(DB_QUERY), sum(sum(s[:-1]) for s in DB_COMMIT.series.values())
+    rows, flushes = world.rows_written, world.flushes
+    started = time.perf_counter()
+    await clock.run(until=args.hours * 3600)
+    manager.stop()
+    flusher.cancel()
+    await asyncio.gather(*manager.tasks, *manager.narrations, flusher, return_exceptions=True)
+    await world.flush()  # Хвост, который не успел сброситься
+    wall = time.perf_counter() - started
+    sim_hours = clock.now() / 3600
+    after = db_statements(DB_QUERY)
+    writes = {verb: after.get(verb, 0) - statements.get(verb, 0) for verb in ('INSERT', 'UPDATE', 'DELETE')}
+    commits = sum(sum(s[:-1]) for s in DB_COMMIT.series.values()) - commits
+    per_hour = lambda value: round(value / sim_hours, 1) if sim_hours else 0.0
+    report = {
+        "seed": args.seed,
+        "npcs": len(world.npcs),
+        "sim_seconds": clock.now(),
+        "wall_seconds": round(wall, 3),
+        "sim_seconds_per_wall_second": round(clock.now() / wall, 1) if wall else 0.0,
+        "ticks": manager.scheduler.ticks,
+        "npc_actions": manager.scheduler.npcs_processed,
+        "npc_actions_per_wall_second": round(manager.scheduler.npcs_processed / wall) if wall else 0,
+        "ai_replies": responder.calls,
+        "published": dict(published),
+        "db": {
+            "flushes": world.flushes - flushes,
+            "rows_written": world.rows_written - rows,
+            "commits": commits,
+            "statements": writes,
+            "rows_per_sim_hour": per_hour(world.rows_written - rows),
+            "flushes_per_sim_hour": per_hour(world.flushes - flushes),
+            "commits_per_sim_hour": per_hour(commits),
+            "statements_per_sim_hour": {verb: per_hour(n) for verb, n in writes.items()},
+        },
+        "fingerprint": fingerprint(world),  # Совпадает у прогонов с одинаковыми seed/npcs/hours
+    }
+    await engine.dispose()
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--hours', type=float, default=24, help='Симулированных часов')
+    parser.add_argument('--npcs', type=int, default=0, help='Сколько NPC засеять (0 — встроенные профили)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--db', default=None, help='Файл SQLite; по умолчанию — новый временный')
+    parser.add_argument('--profile', action='store_true', help='cProfile прогона: 30 самых дорогих функций')
+    parser.add_argument('--out', default=None, help='Сохранить отчёт в JSON')
+    args = parser.parse_args()
+    db = args.db or os.path.join(tempfile.mkdtemp(prefix='city-headless-'), 'city.db')
+    os.environ['SQLITE_URL'] = f"sqlite+aiosqlite:///{db}"
+    os.environ['NPC_COUNT'] = str(args.npcs)
+    os.environ.setdefault('OPENAI_API_KEY', 'headless')  # Клиент создаётся при импорте, но не вызывается
+    prof = cProfile.Profile() if args.profile else None
+    if prof:
+        prof.enable()
+    report = asyncio.run(run(args))
+    if prof:
+        prof.disable()
+        out = io.StringIO()
+        pstats.Stats(prof, stream=out).sort_stats('cumulative').print_stats(30)
+        print(out.getvalue())
+    report["db_file"] = db
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+if __name__ == '__main__':
+    main()
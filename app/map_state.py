@@ -0,0 +1,133 @@
+import asyncio
+import logging
+import os
+from collections import deque
+from .chat_ws import manager
+from .spatial import npc_index
+from .world import world
+
+logger = logging.getLogger(__name__)
+
+MAP_UPDATE_RATES = sorted(float(r) for r in os.environ.get('MAP_UPDATE_RATES', '1,2,5,10').split(','))  # Гц
+MAP_DEFAULT_RATE = float(os.environ.get('MAP_DEFAULT_RATE', 1))
+MAP_HISTORY = int(os.environ.get('MAP_HISTORY', 20000))  # Изменений в журнале для /map?since
+MAP_STATE_FIELDS = ('mood', 'money', 'location', 'business')  # Поля state, которые видит карта
+
+class MapAggregator:
+    """Копит изменения позиций/состояний NPC и рассылает их пачками (дельтами) с выбранной частотой."""
+
+    def __init__(self, history: int = MAP_HISTORY, rates=MAP_UPDATE_RATES):
+        self.version = 0
+        self.floor = 0  # Самая старая версия, от которой ещё можно построить дельту
+        self.entities = {}  # npc_id -> плоский словарь полей
+        self.log = deque()  # (version, npc_id, изменённые поля)
+        self.history = history
+        self.rates = rates
+        self.sent_version = {}  # rate -> последняя разосланная версия
+        self.region_members = {}  # (rate, rect) -> NPC внутри региона на момент последней рассылки
+        self.tasks = []
+
+    def topic_for(self, rate=None) -> str:
+        try:
+            rate = float(rate) if rate is not None else MAP_DEFAULT_RATE
+        except ValueError:
+            rate = MAP_DEFAULT_RATE
+        rate = min(self.rates, key=lambda r: abs(r - rate))
+        return f"map_update:{rate:g}"
+
+    def set_entity(self, npc):
+        self.entities[npc.id] = {
+            "id": npc.id, "name": npc.name, "profession": npc.profession, "x": npc.x, "y": npc.y,
+            **{k: getattr(npc, k) for k in MAP_STATE_FIELDS},
+        }
+
+    def load(self):
+        for npc in world.npcs.values():
+            self.set_entity(npc)
+        self.version += 1
+        self.floor = self.version
+
+    def update(self, npc_id: int, fields: dict):
+        ent = self.entities.setdefault(npc_id, {"id": npc_id})
+        changed = {k: v for k, v in fields.items() if k != 'id' and ent.get(k) != v}
+        if not changed:
+            return
+        ent.update(changed)
+        self.version += 1
+        if len(self.log) >= self.history:
+            self.floor = self.log.popleft()[0]
+        self.log.append((self.version, npc_id, changed))
+
+    def update_state(self, npc_id: int, state: dict):
+        self.update(npc_id, {k: state.get(k) for k in MAP_STATE_FIELDS if k in state})
+
+    def snapshot(self, rect=None):
+        ids = self.entities if rect is None else [i for i in npc_index.query_rect(*rect) if i in self.entities]
+        return {"version": self.version, "full": True, "npcs": {str(i): dict(self.entities[i]) for i in ids}}
+
+    def since(self, version: int, rect=None):
+        # Только изменённые поля после version; если журнал уже не покрывает version — полный снимок
+        if version < self.floor:
+            return self.snapshot(rect)
+        inside = None if rect is None else set(npc_index.query_rect(*rect))
+        npcs = {}
+        for v, npc_id, fields in reversed(self.log):
+            if v <= version:
+                break
+            if inside is not None and npc_id not in inside:
+                continue
+            ent = npcs.setdefault(str(npc_id), {})
+            for k, val in fields.items():
+                ent.setdefault(k, val)
+        return {"version": self.version, "since": version, "full": False, "npcs": npcs}
+
+    def region_delta(self, delta: dict, rate: float, rect):
+        # Дельта для подписчиков региона: вошедшие NPC приходят целиком, ушедшие — в removed
+        inside = set(npc_index.query_rect(*rect))
+        prev = self.region_members.get((rate, rect), inside)
+        self.region_members[(rate, rect)] = inside
+        if delta['full']:
+            return self.snapshot(rect)
+        npcs = {key: fields for key, fields in delta['npcs'].items() if int(key) in inside}
+        for npc_id in inside - prev:
+            if npc_id in self.entities:
+                npcs[str(npc_id)] = dict(self.entities[npc_id])
+        return {**delta, "npcs": npcs, "removed": sorted(prev - inside)}
+
+    async def flush_loop(self, rate: float):
+        topic = self.topic_for(rate)
+        interval = 1.0 / rate
+        while True:
+            await asyncio.sleep(interval)
+            last = self.sent_version.get(rate, self.version)
+            if self.version == last:
+                continue
+            conns = manager.topics.get(topic)
+            regions = set()
+            if conns:
+                regions = {c.meta['region'] for c in conns.values() if c.meta.get('region')}
+                try:
+                    delta = self.since(last)
+                    await manager.broadcast(topic, {"type": "map_delta", "data": delta}, where=lambda m: not m.get('region'))
+                    for rect in regions:
+                        rd = self.region_delta(delta, rate, rect)
+                        if rd['full'] or rd['npcs'] or rd['removed']:  # В регионе ничего не изменилось — молчим
+                            await manager.broadcast(topic, {"type": "map_delta", "data": rd},
+                                                    where=lambda m, rect=rect: m.get('region') == rect)
+                except Exception as e:
+                    logger.error(f"Ошибка рассылки карты ({topic}): {e}")
+            for key in [k for k in self.region_members if k[0] == rate and k[1] not in regions]:
+                del self.region_members[key]
+            self.sent_version[rate] = self.version
+
+    def start(self):
+        for rate in self.rates:
+            self.sent_version[rate] = self.version
+            self.tasks.append(asyncio.create_task(self.flush_loop(rate)))
+
+    def stop(self):
+        for t in self.tasks:
+            t.cancel()
+        self.tasks = []
+
+map_state = MapAggregator()
@@ -0,0 +1,136 @@
+import asyncio
+import logging
+import os
+from sqlalchemy import select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from .db import AsyncSessionLocal
+from .models import Summary
+from .world import world
+from .ai import generate_reply, build_messages, estimate_tokens, BACKGROUND, FALLBACK_REPLY
+from .metrics import registry, PROMPT_TOKENS_SAVED
+
+logger = logging.getLogger(__name__)
+
+MEMORY_RECENT = int(os.environ.get('MEMORY_RECENT', 4))  # Последних реплик в промпте дословно
+MEMORY_SUMMARIZE_AFTER = int(os.environ.get('MEMORY_SUMMARIZE_AFTER', 4))  # Несжатых реплик сверх MEMORY_RECENT, после которых обновляем содержание
+MEMORY_SUMMARY_CHARS = int(os.environ.get('MEMORY_SUMMARY_CHARS', 800))  # Предел длины содержания
+MEMORY_REFRESH_BATCH = int(os.environ.get('MEMORY_REFRESH_BATCH', 50))  # Реплик за одно обновление
+BASELINE_HISTORY = 10  # Столько последних сообщений шло в промпт до памяти — база для подсчёта экономии
+
+def as_history(messages) -> list:
+    return [{'role': 'user' if m.role == 'npc' else m.role, 'content': m.content} for m in messages]
+
+class ConversationMemory:
+    """Память NPC о разговорах: сжатое содержание старых реплик + несколько последних дословно.
+
+    Содержание обновляется в фоне (приоритет BACKGROUND), когда несжатый хвост перерастает порог,
+    и хранится в таблице summaries рядом с messages — переживает перезапуск и архивацию старых сообщений.
+    """
+
+    def __init__(self, recent: int = MEMORY_RECENT, summarize_after: int = MEMORY_SUMMARIZE_AFTER,
+                 summary_chars: int = MEMORY_SUMMARY_CHARS, refresh_batch: int = MEMORY_REFRESH_BATCH):
+        self.recent = recent
+        self.summarize_after = summarize_after
+        self.summary_chars = summary_chars
+        self.refresh_batch = refresh_batch
+        self.summaries = {}  # npc_id -> (content, upto_id)
+        self.refreshing = {}  # npc_id -> Task: одно обновление на NPC
+        self.calls = 0
+        self.tokens_saved = 0
+        self.last_saved = 0
+        self.refreshes = 0
+        self.refresh_skipped = 0
+        self.refresh_errors = 0
+
+    async def summary(self, npc_id: int):
+        if npc_id not in self.summaries:
+            async with AsyncSessionLocal() as db:
+                row = (await db.execute(select(Summary).where(Summary.npc_id == npc_id))).scalar()
+            self.summaries[npc_id] = (row.content, row.upto_id) if row else ('', 0)
+        return self.summaries[npc_id]
+
+    async def context(self, npc, system: str, user_message: str) -> list:
+        # История для промпта: содержание + несжатый хвост; старый промпт считаем только для экономии
+        content, upto = await self.summary(npc.id)
+        limit = self.recent + self.summarize_after
+        hist = await world.recent_messages(npc.id, max(BASELINE_HISTORY, limit))
+        tail = [m for m in hist if m.id is None or m.id > upto][-limit:]  # id нет у ещё не сброшенных ведущим
+        if len(tail) >= limit:
+            self.schedule(npc)
+        history = ([{'role': 'system', 'content': f"Что было раньше: {content}"}] if content else []) + as_history(tail)
+        baseline = estimate_tokens(build_messages(system, as_history(hist[-BASELINE_HISTORY:]), user_message))
+        saved = baseline - estimate_tokens(build_messages(system, history, user_message))
+        self.calls += 1
+        self.tokens_saved += saved
+        self.last_saved = saved
+        PROMPT_TOKENS_SAVED.observe(saved)
+        return history
+
+    def schedule(self, npc):
+        if npc.id in self.refreshing:
+            return
+        task = asyncio.create_task(self.refresh(npc))
+        self.refreshing[npc.id] = task
+        task.add_done_callback(lambda _: self.refreshing.pop(npc.id, None))
+
+    async def refresh(self, npc):
+        # Сжимаем несжатое, кроме последних recent реплик, вместе с прежним содержанием
+        try:
+            content, upto = await self.summary(npc.id)
+            latest = await world.recent_messages(npc.id, self.recent)
+            if len(latest) < self.recent:
+                return
+            old = [m for m in await world.messages_after(npc.id, upto, self.refresh_batch)
+                   if latest[0].id is None or m.id < latest[0].id]
+            if not old:
+                return
+            system = (f"Ты ведёшь память персонажа {npc.name}. Сожми разговор в краткое содержание: факты, "
+                      f"обещания, отношение к собеседникам. Не больше {self.summary_chars} символов.")
+            lines = '\n'.join(m.content for m in old)
+            reply = await generate_reply(system, [], f"Прежнее содержание: {content or 'нет'}\nНовые реплики:\n{lines}",
+                                         priority=BACKGROUND)
+            if reply is None:  # Бюджет фоновых вызовов исчерпан — сожмём при следующем разговоре
+                self.refresh_skipped += 1
+                return
+            if reply == FALLBACK_REPLY:
+                self.refresh_errors += 1
+                return
+            await self.store(npc.id, reply[:self.summary_chars], old[-1].id)
+            self.refreshes += 1
+        except Exception as e:
+            self.refresh_errors += 1
+            logger.error(f"Ошибка обновления памяти NPC {npc.id}: {e}")
+
+    async def store(self, npc_id: int, content: str, upto_id: int):
+        self.summaries[npc_id] = (content, upto_id)
+        stmt = sqlite_insert(Summary).values(npc_id=npc_id, content=content, upto_id=upto_id)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['npc_id'],
+            set_={"content": stmt.excluded.content, "upto_id": stmt.excluded.upto_id},
+            where=Summary.upto_id < stmt.excluded.upto_id,  # Другой воркер мог сжать дальше
+        )
+        async with AsyncSessionLocal() as db:
+            await db.execute(stmt)
+            await db.commit()
+
+    def stop(self):
+        for task in list(self.refreshing.values()):
+            task.cancel()
+
+    def stats(self):
+        return {
+            "calls": self.calls,
+            "tokens_saved": self.tokens_saved,
+            "tokens_saved_per_call": round(self.tokens_saved / self.calls, 1) if self.calls else 0.0,
+            "last_saved": self.last_saved,
+            "refreshes": self.refreshes,
+            "refresh_skipped": self.refresh_skipped,
+            "refresh_errors": self.refresh_errors,
+            "refreshing": len(self.refreshing),
+        }
+
+memory = ConversationMemory()
+
+registry.callback('ai_memory_refreshes_total', 'Обновления сжатой памяти разговоров по результату',
+                  lambda: {'ok': memory.refreshes, 'skipped': memory.refresh_skipped, 'error': memory.refresh_errors},
+                  ('result',), kind='counter')
@@ -0,0 +1,240 @@
+import asyncio
+import cProfile
+import io
+import os
+import pstats
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+try:
+    from pyinstrument import Profiler  # Сэмплирующий профайлер, если установлен
+except ImportError:
+    Profiler = None
+
+METRICS_LAG_INTERVAL = float(os.environ.get('METRICS_LAG_INTERVAL', 0.5))  # Как часто мерить лаг event loop
+METRICS_PROFILER = os.environ.get('METRICS_PROFILER', '0') == '1'  # Разрешить /debug/profile
+METRICS_PROFILE_MAX = float(os.environ.get('METRICS_PROFILE_MAX', 30))  # Максимум секунд профилирования
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def _labels(names, values) -> str:
+    if not names:
+        return ''
+    pairs = ','.join(f'{n}="{str(v)}"' for n, v in zip(names, values))
+    return '{' + pairs + '}'
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self.values = {}
+
+    def inc(self, *labels, value: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + value
+
+    def render(self):
+        return [f"{self.name}{_labels(self.label_names, k)} {v}" for k, v in self.values.items()]
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, *labels, value: float):
+        self.values[labels] = value
+
+class CallbackMetric(Metric):
+    """Значения считаются при скрейпе: fn() -> число или {метки: число}."""
+
+    def __init__(self, name, help, fn, labels=(), kind='gauge'):
+        super().__init__(name, help, labels)
+        self.fn = fn
+        self.kind = kind
+
+    def render(self):
+        value = self.fn()
+        items = value.items() if isinstance(value, dict) else [((), value)]
+        return [f"{self.name}{_labels(self.label_names, k if isinstance(k, tuple) else (k,))} {v}" for k, v in items]
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        self.series = {}  # метки -> [счётчики по корзинам..., +Inf, сумма]
+
+    def observe(self, value: float, *labels):
+        s = self.series.get(labels)
+        if s is None:
+            s = self.series[labels] = [0] * (len(self.buckets) + 2)
+        s[bisect_left(self.buckets, value)] += 1
+        s[-1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def render(self):
+        out = []
+        for labels, s in self.series.items():
+            total = 0
+            for bound, n in zip(self.buckets + ('+Inf',), s):
+                total += n
+                out.append(f"{self.name}_bucket{_labels(self.label_names + ('le',), labels + (bound,))} {total}")
+            out.append(f"{self.name}_sum{_labels(self.label_names, labels)} {s[-1]}")
+            out.append(f"{self.name}_count{_labels(self.label_names, labels)} {total}")
+        return out
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self.register(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def callback(self, name, help, fn, labels=(), kind='gauge'):
+        return self.register(CallbackMetric(name, help, fn, labels, kind))
+
+    def render(self) -> str:
+        lines = []
+        for m in self.metrics:
+            lines += m.header()
+            try:
+                lines += m.render()
+            except Exception as e:  # Упавший колбэк не должен ломать весь /metrics
+                lines.append(f"# {m.name} error: {e}")
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+
+LOOP_LAG = registry.histogram('event_loop_lag_seconds', 'Задержка пробуждения event loop сверх ожидаемой',
+                              buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5))
+HTTP_LATENCY = registry.histogram('http_request_duration_seconds', 'Время обработки HTTP-запроса', ('method', 'route', 'status'))
+WS_ACTION = registry.histogram('ws_action_duration_seconds', 'Время обработки действия из WebSocket', ('topic', 'action'))
+DB_QUERY = registry.histogram('db_query_duration_seconds', 'Время SQL-запроса', ('statement',))
+DB_COMMIT = registry.histogram('db_commit_duration_seconds', 'Время flush + commit сессии')
+AI_REPLY = registry.histogram('ai_reply_duration_seconds', 'Время generate_reply/stream_reply целиком', ('priority', 'source'),
+                              buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+AI_UPSTREAM = registry.histogram('ai_upstream_duration_seconds', 'Время вызова OpenAI', ('priority',),
+                                 buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+WS_BROADCAST = registry.histogram('ws_broadcast_duration_seconds', 'Сериализация и постановка кадра в очереди подписчиков', ('topic',),
+                                  buckets=(0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05, 0.1))
+WS_SEND = registry.histogram('ws_send_duration_seconds', 'Отправка одного кадра в сокет', ('topic',))
+PROMPT_TOKENS_SAVED = registry.histogram('ai_prompt_tokens_saved', 'Сэкономлено токенов промпта за вызов против 10 последних сообщений',
+                                         buckets=(0, 25, 50, 100, 200, 400, 800, 1600))
+LOOP_ITERATION = registry.histogram('loop_iteration_duration_seconds', 'Время одной итерации фонового цикла', ('loop',))
+
+KNOWN_TOPICS = ('news', 'state_update')
+
+def topic_label(topic: str) -> str:
+    # npc_<id> и произвольные топики клиентов схлопываем, иначе число рядов растёт без предела
+    if topic.startswith('npc_'):
+        return 'npc'
+    if topic.startswith('map_update') or topic in KNOWN_TOPICS:
+        return topic
+    return 'other'
+
+async def lag_monitor(interval: float = METRICS_LAG_INTERVAL):
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        LOOP_LAG.observe(max(0.0, time.perf_counter() - started - interval))
+
+class MetricsMiddleware:
+    """ASGI-обёртка: гистограмма по шаблону маршрута (/chat_history/{npc_id}), а не по сырому пути."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        status = ['500']
+
+        async def send_wrapper(message):
+            if message['type'] == 'http.response.start':
+                status[0] = str(message['status'])
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get('route')
+            HTTP_LATENCY.observe(time.perf_counter() - started, scope['method'], getattr(route, 'path', 'unmatched'), status[0])
+
+def instrument_engine(engine):
+    from sqlalchemy import event
+    from sqlalchemy.orm import Session
+
+    @event.listens_for(engine.sync_engine, 'before_cursor_execute')
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+    @event.listens_for(engine.sync_engine, 'after_cursor_execute')
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info['query_started'].pop()
+        verb = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else 'OTHER'
+        DB_QUERY.observe(time.perf_counter() - started, verb if verb in ('SELECT', 'INSERT', 'UPDATE', 'DELETE') else 'OTHER')
+
+    @event.listens_for(engine.sync_engine, 'handle_error')
+    def _error(ctx):
+        stack = ctx.connection.info.get('query_started') if ctx.connection is not None else None
+        if stack:
+            stack.pop()
+
+    @event.listens_for(Session, 'before_commit')
+    def _before_commit(session):
+        session.info['commit_started'] = time.perf_counter()
+
+    @event.listens_for(Session, 'after_commit')
+    def _after_commit(session):
+        started = session.info.pop('commit_started', None)
+        if started is not None:
+            DB_COMMIT.observe(time.perf_counter() - started)
+
+    pool = engine.sync_engine.pool
+    registry.callback('db_connections_in_use', 'Соединений, выданных сессиям', lambda: pool.checkedout() if hasattr(pool, 'checkedout') else 0)
+
+async def profile(seconds: float) -> str:
+    # Профиль всего, что event loop выполнял за seconds секунд
+    seconds = max(0.1, min(seconds, METRICS_PROFILE_MAX))
+    if Profiler is not None:
+        profiler = Profiler(async_mode='disabled')
+        profiler.start()
+        await asyncio.sleep(seconds)
+        profiler.stop()
+        return profiler.output_text(unicode=True)
+    prof = cProfile.Profile()
+    prof.enable()
+    await asyncio.sleep(seconds)
+    prof.disable()
+    out = io.StringIO()
+    pstats.Stats(prof, stream=out).sort_stats('cumulative').print_stats(40)
+    return out.getvalue()
@@ -0,0 +1,47 @@
+import json
+import logging
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+NPC_STATE_COLUMNS = {
+    "mood": "VARCHAR DEFAULT 'neutral'",
+    "money": "INTEGER DEFAULT 100",
+    "location": "VARCHAR DEFAULT 'home'",
+    "business": "TEXT",
+}
+
+def _columns(conn, table: str):
+    return {row[1] for row in conn.execute(text(f"PRAGMA table_info({table})"))}
+
+def migrate_npc_state(conn):
+    # Старые city.db: JSON-колонка npcs.state -> типизированные колонки + таблица relations
+    cols = _columns(conn, 'npcs')
+    for name, ddl in NPC_STATE_COLUMNS.items():
+        if name not in cols:
+            conn.execute(text(f"ALTER TABLE npcs ADD COLUMN {name} {ddl}"))
+    for name in ('mood', 'money', 'location'):
+        conn.execute(text(f"CREATE INDEX IF NOT EXISTS ix_npcs_{name} ON npcs ({name})"))
+    if 'state' not in cols:
+        return
+    rows = conn.execute(text("SELECT id, name, state FROM npcs WHERE state IS NOT NULL")).all()
+    ids = {name: npc_id for npc_id, name, _ in rows}
+    edges = []
+    for npc_id, _, raw in rows:
+        state = json.loads(raw) if isinstance(raw, str) else (raw or {})
+        conn.execute(
+            text("UPDATE npcs SET mood = :mood, money = :money, location = :location, business = :business WHERE id = :id"),
+            {"id": npc_id, "mood": state.get('mood', 'neutral'), "money": state.get('money', 100),
+             "location": state.get('location', 'home'), "business": state.get('business')},
+        )
+        for other_name, kind in (state.get('relations') or {}).items():
+            if other_name in ids:
+                edges.append({"npc_id": npc_id, "other_id": ids[other_name], "kind": kind})
+    if edges:
+        conn.execute(text("INSERT OR IGNORE INTO relations (npc_id, other_id, kind) VALUES (:npc_id, :other_id, :kind)"), edges)
+    conn.execute(text("UPDATE npcs SET state = NULL"))  # Блоб больше не источник правды
+    logger.info(f"Мигрировано состояние {len(rows)} NPC, отношений: {len(edges)}")
+
+def migrate_indexes(conn):
+    # create_all не добавляет индексы в уже существующие таблицы
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_messages_npc_id_id ON messages (npc_id, id)"))
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Float, JSON, Text
+from sqlalchemy import Column, Integer, String, Float, Text, Index
 from .db import Base
 
 class NPC(Base):
@@ -7,16 +7,41 @@ class NPC(Base):
     name = Column(String, unique=True, index=True)
     profession = Column(String)
     personality = Column(Text)
-    state = Column(JSON, default={"mood": "neutral", "money": 100, "location": "home", "relations": {}, "business": None})  # Добавил relations, business
+    # Горячие поля бывшего JSON state: отдельные колонки, UPDATE пишет только изменённые
+    mood = Column(String, default="neutral", index=True)
+    money = Column(Integer, default=100, index=True)
+    location = Column(String, default="home", index=True)
+    business = Column(Text, nullable=True)
     x = Column(Float, default=0.0)
     y = Column(Float, default=0.0)
 
+    @property
+    def state(self):
+        # Совместимый вид для API/рассылок (отношения — в таблице relations)
+        return {"mood": self.mood, "money": self.money, "location": self.location, "business": self.business}
+
+class Relation(Base):  # Отношения NPC: ребро npc -> other
+    __tablename__ = 'relations'
+    id = Column(Integer, primary_key=True)
+    npc_id = Column(Integer, nullable=False)
+    other_id = Column(Integer, nullable=False)
+    kind = Column(String, default="neutral")  # friend, neutral, enemy
+    __table_args__ = (Index('ix_relations_npc_other', 'npc_id', 'other_id', unique=True),)
+
 class Message(Base):
     __tablename__ = 'messages'
     id = Column(Integer, primary_key=True, index=True)
     npc_id = Column(Integer, index=True)
     role = Column(String)
     content = Column(Text)
+    __table_args__ = (Index('ix_messages_npc_id_id', 'npc_id', 'id'),)  # Курсорная пагинация истории
+
+class Summary(Base):  # Сжатая память разговоров NPC: всё до upto_id включительно
+    __tablename__ = 'summaries'
+    id = Column(Integer, primary_key=True)
+    npc_id = Column(Integer, unique=True, index=True)
+    content = Column(Text)
+    upto_id = Column(Integer, default=0)  # Последний Message.id, вошедший в содержание
 
 class Event(Base):
     __tablename__ = 'events'
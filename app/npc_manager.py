@@ -1,13 +1,26 @@
-import asyncio, random
-from datetime import datetime
+import random, os, time
 import logging
-from .db import SessionLocal
-from .models import NPC, Message, Event, Location, Weather
-from .ai import generate_reply
+from sqlalchemy import select, func
+from .db import AsyncSessionLocal
+from .models import NPC, Relation
+from .ai import generate_reply, BACKGROUND
+from .scheduler import TickScheduler
+from .clock import RealClock
+from .population import Population
+from .spatial import npc_index
+from .world import world
+from .metrics import LOOP_ITERATION
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+NPC_TICK_INTERVAL = float(os.environ.get('NPC_TICK_INTERVAL', 1.0))  # Секунд между тиками
+NPC_TICK_BATCH = int(os.environ.get('NPC_TICK_BATCH', 500))  # Максимум NPC за тик
+CHAT_NEIGHBOURS = int(os.environ.get('CHAT_NEIGHBOURS', 3))  # Собеседник выбирается среди ближайших
+NPC_COUNT = int(os.environ.get('NPC_COUNT', 0))  # Сколько NPC засеять; больше профилей — клоны с номером (нагрузочные тесты)
+NPC_NARRATION_MAX = int(os.environ.get('NPC_NARRATION_MAX', 100))  # AI-описаний в полёте; сверх — без описания
+NPC_SEED_RELATIONS = int(os.environ.get('NPC_SEED_RELATIONS', 50))  # Отношений на NPC при засеве, чтобы не было N^2 рёбер
+
 DEFAULT_NPC_PROFILES = [
     {"name": "Анна", "profession": "Бариста", "personality": "дружелюбная, болтливая, оптимист"},
     {"name": "Пётр", "profession": "Полицейский", "personality": "строгий, справедливый, серьёзный"},
@@ -24,175 +37,218 @@ DEFAULT_NPC_PROFILES = [
     {"name": "Галина", "profession": "Пенсионерка", "personality": "ворчливая, мудрая"},
 ]
 
+def seed_profiles(count: int = 0):
+    count = max(count, len(DEFAULT_NPC_PROFILES))
+    out = []
+    for i in range(count):
+        p = DEFAULT_NPC_PROFILES[i % len(DEFAULT_NPC_PROFILES)]
+        suffix = i // len(DEFAULT_NPC_PROFILES)
+        out.append(dict(p, name=f"{p['name']} {suffix + 1}") if suffix else p)
+    return out
+
 class NPCManager:
-    def __init__(self, broadcaster):
+    def __init__(self, broadcaster, clock=None, rng=None, responder=None, seed=None):
+        # clock/rng/responder подменяет прогон без сервера (app/headless.py): виртуальное время, seed, ответы без OpenAI
         self.broadcaster = broadcaster
+        self.clock = clock or RealClock()
+        self.rng = rng or random
+        self.reply = responder or generate_reply
         self.tasks = []
+        self.narrations = set()  # Фоновые AI-описания: тик их не ждёт
+        self.narration_shed = 0
+        self.ideas = set()  # NPC, чья бизнес-идея ещё в полёте: второй не запускаем
         self.seeded = False
+        self.scheduler = TickScheduler(max_batch=NPC_TICK_BATCH)
+        self.population = Population(seed)
 
-    def seed(self):
-        db = SessionLocal()
-        try:
-            existing = db.query(NPC).count()
-            if existing >= len(DEFAULT_NPC_PROFILES):
+    async def seed(self):
+        profiles = seed_profiles(NPC_COUNT)
+        async with AsyncSessionLocal() as db:
+            existing = (await db.execute(select(func.count(NPC.id)))).scalar()
+            if existing >= len(profiles):
                 return
+            names = set((await db.execute(select(NPC.name))).scalars())
             npcs = []
-            for p in DEFAULT_NPC_PROFILES:
-                relations = {other['name']: random.choice(['friend', 'neutral', 'enemy']) for other in DEFAULT_NPC_PROFILES if other['name'] != p['name']}
+            for p in profiles:
+                if p['name'] in names:
+                    continue
                 npc = NPC(
                     name=p['name'],
                     profession=p['profession'],
                     personality=p['personality'],
-                    state={"mood": "neutral", "money": 100, "location": "home", "relations": relations, "business": None},
-                    x=random.random() * 800,
-                    y=random.random() * 400
+                    mood="neutral", money=100, location="home", business=None,
+                    x=self.rng.random() * 800,
+                    y=self.rng.random() * 400
                 )
                 npcs.append(npc)
             db.add_all(npcs)
-            db.commit()
-        finally:
-            db.close()
+            await db.flush()  # Нужны id для рёбер отношений
+            db.add_all([
+                Relation(npc_id=npc.id, other_id=other.id, kind=self.rng.choice(['friend', 'neutral', 'enemy']))
+                for npc in npcs
+                for other in self.rng.sample(npcs, min(len(npcs), NPC_SEED_RELATIONS + 1))
+                if other is not npc
+            ])
+            await db.commit()
         self.seeded = True
 
-    async def npc_loop(self, npc):
+    def next_delay(self):
+        return self.rng.randint(10, 30)  # Замедление перемещений
+
+    async def chat(self, npc):
+        others = npc_index.nearest(npc.x, npc.y, k=CHAT_NEIGHBOURS, exclude=npc.id)
+        if not others:
+            others = [i for i in world.npcs if i != npc.id]
+        if not others:
+            return
+        other_id = self.rng.choice(others)
+        other_name = world.npcs[other_id].name
+        relation = world.relation(npc.id, other_id)
+        system = f"Ты {npc.name}, {npc.personality}. Отношение к {other_name}: {relation}. Общайся коротко."
+        history = []
+        reply = await self.reply(system, history, f"Привет, {other_name}! Как дела?", priority=BACKGROUND,
+                                     fallback=f"{npc.name} и {other_name} перекинулись парой слов.")
+        if reply is None:  # Бюджет AI исчерпан — разговора не было
+            return
+        world.add_message(npc.id, 'user', f"NPC_{npc.name}: {reply}")
+        await self.broadcaster('news', world.add_event(f"Разговор: {npc.name} и {other_name}", reply))
+        # Обновление отношений
+        if 'злость' in reply.lower():
+            world.set_relation(npc.id, other_id, 'enemy')
+        elif 'дружба' in reply.lower():
+            world.set_relation(npc.id, other_id, 'friend')
+
+    async def business_idea(self, npc):
+        system = f"Ты {npc.name}, {npc.profession}. Придумай бизнес-идею."
+        idea = await self.reply(system, [], "Предложи идею бизнеса.", priority=BACKGROUND,
+                                    fallback=f"Небольшое дело по профессии: {npc.profession}.")
+        if idea is None:
+            return
+        npc.business = idea
+        self.population.sync(npc)
+        await self.broadcaster('news', world.add_event(f"Новый бизнес: {npc.name}", idea))
+
+    async def disaster(self, npc, loss):
+        # Убыток уже списан в economy(); здесь только описание для ленты
+        disaster = self.rng.choice(['fire', 'theft'])
+        system = f"Генерируй событие катастрофы для {npc.name}."
+        desc = await self.reply(system, [], f"Опиши {disaster}.", priority=BACKGROUND,
+                                    fallback=f"У {npc.name} случилось происшествие ({disaster}), убыток {loss} монет.")
+        if desc is None:
+            return
+        await self.broadcaster('news', world.add_event(f"Катастрофа: {disaster} у {npc.name}", desc))
+
+    def narrate(self, coro):
+        # Отдельная задача: медленный OpenAI не держит тик и рассылку движений
+        if len(self.narrations) >= NPC_NARRATION_MAX:
+            coro.close()
+            self.narration_shed += 1
+            return None
+        task = self.clock.spawn(coro)
+        self.narrations.add(task)
+        task.add_done_callback(self._narrated)
+        return task
+
+    def _narrated(self, task):
+        self.narrations.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Ошибка действия NPC: {task.exception()}")
+
+    async def tick(self, npc_ids):
+        # Один тик: деньги и перемещения всей пачки векторно и сразу в рассылку; AI-описания — в фоне (narrate)
+        started = time.perf_counter()
+        outbox = []
+        pop = self.population
+        idx = pop.indices(npc_ids)
+        res = pop.economy(idx, pop.choose_actions(idx, world.weather.current))
+        pop.write_back(world, res['changed'], res['move'])
+        recs = pop.records
+        for i in res['move'].tolist():
+            npc = recs[i]
+            npc_index.move(npc.id, npc.x, npc.y)
+            outbox.append(('map_update', {"id": npc.id, "x": npc.x, "y": npc.y, "location": npc.location}))
+        for i in res['work'].tolist():
+            outbox.append(('state_update', {"id": recs[i].id, "state": recs[i].state}))
+        shoppers, spent = res['shop']
+        for i, amount in zip(shoppers.tolist(), spent.tolist()):
+            npc = recs[i]
+            outbox.append(('news', world.add_event(f"Покупка: {npc.name}", f"{npc.name} купил вещи на {amount} монет.")))
+        for topic, payload in outbox:
+            await self.broadcaster(topic, payload)
+        victims, losses = res['disaster']
+        for i in res['chat'].tolist():
+            self.narrate(self.chat(recs[i]))
+        for i in res['idea'].tolist():
+            npc = recs[i]
+            if npc.id in self.ideas:  # Population.business выставится, только когда идея придёт
+                continue
+            task = self.narrate(self.business_idea(npc))
+            if task is not None:
+                self.ideas.add(npc.id)
+                task.add_done_callback(lambda _, npc_id=npc.id: self.ideas.discard(npc_id))
+        for i, loss in zip(victims.tolist(), losses.tolist()):
+            self.narrate(self.disaster(recs[i], loss))
+        self.scheduler.record_tick(len(npc_ids), time.perf_counter() - started)
+
+    async def npc_loop(self):
+        # Единый планировщик вместо задачи на каждого NPC
+        clock = self.clock
         while True:
-            await asyncio.sleep(random.randint(10, 30))  # Замедление перемещений
-            db = SessionLocal()
+            nxt = self.scheduler.next_due()
+            wait = NPC_TICK_INTERVAL if nxt is None else max(NPC_TICK_INTERVAL, nxt - clock.now())
+            await clock.sleep(wait)
+            due = self.scheduler.pop_due(clock.now())
+            if not due:
+                continue
             try:
-                weather = db.query(Weather).first().current
-                actions = ['move', 'chat', 'work', 'shop', 'business', 'disaster']  # Добавил business, disaster
-                if weather == 'rainy':
-                    actions = ['move'] if random.random() > 0.5 else actions  # Чаще дома
-                action = random.choice(actions)
-                if action == 'move':
-                    locations = db.query(Location).all()
-                    target_loc = random.choice(locations)
-                    if weather == 'sunny' and target_loc.name == 'park':
-                        target_loc = db.query(Location).filter_by(name='park').first()  # Предпочтение парку в солнце
-                    npc.x = random.uniform(target_loc.x_min, target_loc.x_max)
-                    npc.y = random.uniform(target_loc.y_min, target_loc.y_max)
-                    npc.state['location'] = target_loc.name
-                    db.commit()
-                    await self.broadcaster('map_update', {"id": npc.id, "x": npc.x, "y": npc.y, "location": target_loc.name})
-                elif action == 'chat':
-                    others = db.query(NPC).filter(NPC.id != npc.id).all()
-                    if not others:
-                        return
-                    other = random.choice(others)
-                    relation = npc.state['relations'].get(other.name, 'neutral')
-                    system = f"Ты {npc.name}, {npc.personality}. Отношение к {other.name}: {relation}. Общайся коротко."
-                    history = []
-                    reply = await generate_reply(system, history, f"Привет, {other.name}! Как дела?")
-                    db.add(Message(npc_id=npc.id, role='user', content=f"NPC_{npc.name}: {reply}"))
-                    db.commit()
-                    ev = Event(
-                        title=f"Разговор: {npc.name} и {other.name}",
-                        content=reply,
-                        ts=str(datetime.utcnow())
-                    )
-                    db.add(ev)
-                    db.commit()
-                    await self.broadcaster('news', {"title": ev.title, "content": ev.content, "ts": ev.ts})
-                    # Обновление отношений
-                    if 'злость' in reply.lower():
-                        npc.state['relations'][other.name] = 'enemy'
-                    elif 'дружба' in reply.lower():
-                        npc.state['relations'][other.name] = 'friend'
-                    db.commit()
-                elif action == 'work' and npc.state.get('location') == 'work':
-                    s = npc.state
-                    s['money'] += random.randint(10, 20)
-                    npc.state = s
-                    db.commit()
-                    await self.broadcaster('state_update', {"id": npc.id, "state": npc.state})
-                elif action == 'shop' and npc.state.get('location') == 'shop':
-                    s = npc.state
-                    spent = random.randint(5, 15)
-                    s['money'] = max(0, s['money'] - spent)
-                    npc.state = s
-                    db.commit()
-                    ev = Event(
-                        title=f"Покупка: {npc.name}",
-                        content=f"{npc.name} купил вещи на {spent} монет.",
-                        ts=str(datetime.utcnow())
-                    )
-                    db.add(ev)
-                    db.commit()
-                    await self.broadcaster('news', {"title": ev.title, "content": ev.content, "ts": ev.ts})
-                elif action == 'business':
-                    if not npc.state['business']:
-                        system = f"Ты {npc.name}, {npc.profession}. Придумай бизнес-идею."
-                        idea = await generate_reply(system, [], "Предложи идею бизнеса.")
-                        npc.state['business'] = idea
-                        db.commit()
-                        ev = Event(title=f"Новый бизнес: {npc.name}", content=idea, ts=str(datetime.utcnow()))
-                        db.add(ev)
-                        db.commit()
-                        await self.broadcaster('news', {"title": ev.title, "content": ev.content, "ts": ev.ts})
-                    else:
-                        npc.state['money'] += random.randint(5, 10)  # Доход от бизнеса
-                        db.commit()
-                elif action == 'disaster':
-                    if random.random() < 0.1:  # Редко
-                        disaster = random.choice(['fire', 'theft'])
-                        system = f"Генерируй событие катастрофы для {npc.name}."
-                        desc = await generate_reply(system, [], f"Опиши {disaster}.")
-                        ev = Event(title=f"Катастрофа: {disaster} у {npc.name}", content=desc, ts=str(datetime.utcnow()))
-                        db.add(ev)
-                        db.commit()
-                        await self.broadcaster('news', {"title": ev.title, "content": ev.content, "ts": ev.ts})
-                        npc.state['money'] -= random.randint(20, 50)  # Убыток
-                        db.commit()
+                with LOOP_ITERATION.time('npc_loop'):
+                    await self.tick(due)
+            except Exception as e:
+                logger.error(f"Ошибка тика NPC: {e!r}")
             finally:
-                db.close()
+                now = clock.now()  # Иначе NPC из упавшей пачки выпадут из расписания навсегда
+                for npc_id in due:
+                    self.scheduler.schedule(npc_id, now + self.next_delay())
 
     async def weather_loop(self):
         while True:
-            await asyncio.sleep(300)  # Каждые 5 мин
-            db = SessionLocal()
+            await self.clock.sleep(300)  # Каждые 5 мин
             try:
-                weather = db.query(Weather).first()
-                weather.current = random.choice(['sunny', 'rainy', 'stormy'])
-                db.commit()
-                ev = Event(title="Погода изменилась", content=f"Теперь {weather.current}.", ts=str(datetime.utcnow()))
-                db.add(ev)
-                db.commit()
-                await self.broadcaster('news', {"title": ev.title, "content": ev.content, "ts": ev.ts})
-            finally:
-                db.close()
+                with LOOP_ITERATION.time('weather_loop'):
+                    world.weather.current = self.rng.choice(['sunny', 'rainy', 'stormy'])
+                    await self.broadcaster('news', world.add_event("Погода изменилась", f"Теперь {world.weather.current}."))
+            except Exception as e:
+                logger.error(f"Ошибка смены погоды: {e!r}")
 
     async def election_loop(self):
         while True:
-            await asyncio.sleep(300)  # Каждые 5 мин
-            db = SessionLocal()
+            await self.clock.sleep(300)  # Каждые 5 мин
             try:
-                npcs = db.query(NPC).all()
-                votes = {npc.name: 0 for npc in npcs}
-                for voter in npcs:
-                    candidate = random.choice(npcs).name
-                    votes[candidate] += 1
-                winner = max(votes, key=votes.get)
-                ev = Event(title="Выборы мэра", content=f"Новый мэр: {winner} с {votes[winner]} голосами.", ts=str(datetime.utcnow()))
-                db.add(ev)
-                db.commit()
-                await self.broadcaster('news', {"title": ev.title, "content": ev.content, "ts": ev.ts})
-                # Игрок может влиять через команды
-            finally:
-                db.close()
+                with LOOP_ITERATION.time('election_loop'):
+                    winner, votes = self.population.election(world)  # Голоса взвешены отношениями
+                    if winner is not None:
+                        await self.broadcaster('news', world.add_event("Выборы мэра", f"Новый мэр: {winner.name} с {votes} голосами."))
+            except Exception as e:
+                logger.error(f"Ошибка выборов: {e!r}")
+            # Игрок может влиять через команды
 
     async def start(self):
-        self.seed()
-        db = SessionLocal()
-        try:
-            npcs = db.query(NPC).all()
-            for npc in npcs:
-                task = asyncio.create_task(self.npc_loop(npc))
-                self.tasks.append(task)
-            self.tasks.append(asyncio.create_task(self.weather_loop()))
-            self.tasks.append(asyncio.create_task(self.election_loop()))
-        finally:
-            db.close()
+        await self.seed()
+        if not world.loaded:
+            await world.load()
+        for npc in world.npcs.values():
+            npc_index.move(npc.id, npc.x or 0.0, npc.y or 0.0)
+        self.population.load(world)
+        now = self.clock.now()
+        for npc_id in world.npcs:
+            self.scheduler.schedule(npc_id, now + self.next_delay())
+        self.tasks.append(self.clock.spawn(self.npc_loop()))
+        self.tasks.append(self.clock.spawn(self.weather_loop()))
+        self.tasks.append(self.clock.spawn(self.election_loop()))
 
     def stop(self):
-        for t in self.tasks:
-            t.cancel()
\ No newline at end of file
+        for t in self.tasks + list(self.narrations):
+            t.cancel()
+
+    def narration_stats(self):
+        return {"in_flight": len(self.narrations), "shed": self.narration_shed}
\ No newline at end of file
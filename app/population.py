@@ -0,0 +1,157 @@
+import os
+from itertools import chain, repeat
+import numpy as np
+
+ACTIONS = ('move', 'chat', 'work', 'shop', 'business', 'disaster')
+MOVE, CHAT, WORK, SHOP, BUSINESS, DISASTER = range(len(ACTIONS))
+RELATION_WEIGHTS = {'friend': 1.0, 'neutral': 0.0, 'enemy': -1.0}
+
+DISASTER_CHANCE = float(os.environ.get('DISASTER_CHANCE', 0.1))  # Шанс катастрофы, если выпало действие disaster
+ELECTION_NOISE = float(os.environ.get('ELECTION_NOISE', 0.5))  # Разброс симпатий: 0 — голос всегда лучшему другу
+
+class Population:
+    """Экономические столбцы всех NPC в массивах NumPy: тик и выборы — один векторный проход, а не цикл по NPC.
+
+    Массивы — источник правды для денег, позиций и локаций на ведущем воркере; изменённые строки
+    переписываются в записи мира (write_back), дальше их сбрасывает write-behind.
+    """
+
+    def __init__(self, seed=None):
+        self.rng = np.random.default_rng(seed)
+        self.records = []  # NPCRecord по индексу массива
+        self.pos = {}  # npc_id -> индекс
+        self.ids = np.zeros(0, np.int64)
+        self.money = np.zeros(0, np.int64)
+        self.location = np.zeros(0, np.int16)  # Индекс в loc_names, -1 — неизвестная локация
+        self.business = np.zeros(0, bool)
+        self.x = np.zeros(0)
+        self.y = np.zeros(0)
+        self.loc_names = []
+        self.loc_index = {}
+        self.loc_bounds = np.zeros((0, 4))  # x_min, x_max, y_min, y_max
+        self.edges = None  # (src, dst, weight, starts, group): рёбра по индексам массивов, сгруппированные по src
+        self.edges_version = None
+
+    def __len__(self):
+        return len(self.records)
+
+    def load(self, world):
+        self.records = sorted(world.npcs.values(), key=lambda r: r.id)
+        self.pos = {r.id: i for i, r in enumerate(self.records)}
+        self.loc_names = [loc.name for loc in world.locations]
+        self.loc_index = {name: i for i, name in enumerate(self.loc_names)}
+        self.loc_bounds = np.array([[loc.x_min, loc.x_max, loc.y_min, loc.y_max] for loc in world.locations], float).reshape(-1, 4)
+        n = len(self.records)
+        self.ids = np.fromiter((r.id for r in self.records), np.int64, n)
+        self.money = np.fromiter((r.money or 0 for r in self.records), np.int64, n)
+        self.location = np.fromiter((self.loc_index.get(r.location, -1) for r in self.records), np.int16, n)
+        self.business = np.fromiter((bool(r.business) for r in self.records), bool, n)
+        self.x = np.fromiter((r.x or 0.0 for r in self.records), float, n)
+        self.y = np.fromiter((r.y or 0.0 for r in self.records), float, n)
+        self.edges_version = None
+
+    def sync(self, record):
+        # Запись изменили в обход тика (команда игрока, бизнес-идея) — подтягиваем столбцы
+        i = self.pos.get(record.id)
+        if i is None:
+            return
+        self.money[i] = record.money or 0
+        self.location[i] = self.loc_index.get(record.location, -1)
+        self.business[i] = bool(record.business)
+        self.x[i], self.y[i] = record.x or 0.0, record.y or 0.0
+
+    def indices(self, npc_ids) -> np.ndarray:
+        return np.fromiter((self.pos[i] for i in npc_ids if i in self.pos), np.int64)
+
+    def choose_actions(self, idx: np.ndarray, weather: str) -> np.ndarray:
+        actions = self.rng.integers(0, len(ACTIONS), idx.size)
+        if weather == 'rainy':
+            actions[self.rng.random(idx.size) > 0.5] = MOVE  # Чаще дома
+        return actions
+
+    def economy(self, idx: np.ndarray, actions: np.ndarray) -> dict:
+        # Деньги и перемещения пачки за один проход; в ответе — индексы для рассылок и AI-описаний
+        n = idx.size
+        rng = self.rng
+        loc = self.location[idx]
+        money = self.money[idx]
+        work = (actions == WORK) & (loc == self.loc_index.get('work', -2))
+        money[work] += rng.integers(10, 21, int(work.sum()))
+        shop = (actions == SHOP) & (loc == self.loc_index.get('shop', -2))
+        spent = rng.integers(5, 16, int(shop.sum()))
+        money[shop] = np.maximum(0, money[shop] - spent)
+        income = (actions == BUSINESS) & self.business[idx]
+        money[income] += rng.integers(5, 11, int(income.sum()))
+        disaster = (actions == DISASTER) & (rng.random(n) < DISASTER_CHANCE)
+        loss = rng.integers(20, 51, int(disaster.sum()))
+        money[disaster] -= loss  # Убыток
+        changed = money != self.money[idx]
+        self.money[idx] = money
+        movers = idx[actions == MOVE] if len(self.loc_names) else idx[:0]
+        target = rng.integers(0, max(1, len(self.loc_names)), movers.size)
+        bounds = self.loc_bounds[target] if movers.size else np.zeros((0, 4))
+        self.x[movers] = rng.uniform(bounds[:, 0], bounds[:, 1])
+        self.y[movers] = rng.uniform(bounds[:, 2], bounds[:, 3])
+        self.location[movers] = target
+        return {
+            "changed": idx[changed],
+            "move": movers,
+            "work": idx[work],
+            "shop": (idx[shop], spent),
+            "disaster": (idx[disaster], loss),
+            "chat": idx[actions == CHAT],
+            "idea": idx[(actions == BUSINESS) & ~self.business[idx]],
+        }
+
+    def write_back(self, world, changed: np.ndarray, moved: np.ndarray):
+        # Только изменившиеся строки, столбцами; дальше их сбрасывает write-behind
+        recs = self.records
+        if changed.size:
+            world.set_column([recs[i] for i in changed.tolist()], 'money', self.money[changed].tolist())
+        if moved.size:
+            movers = [recs[i] for i in moved.tolist()]
+            world.set_column(movers, 'x', self.x[moved].tolist())
+            world.set_column(movers, 'y', self.y[moved].tolist())
+            world.set_column(movers, 'location', [self.loc_names[i] for i in self.location[moved].tolist()])
+
+    def relation_edges(self, world):
+        # Разреженная матрица отношений (рёбра, сгруппированные по избирателю), а не N×N:
+        # на десятках тысяч NPC плотная не влезет в память
+        if self.edges is None or self.edges_version != world.relations_version:
+            rels = world.relations
+            lookup = np.full(int(self.ids.max(initial=0)) + 1, -1, np.int64)  # npc_id -> индекс
+            lookup[self.ids] = np.arange(self.ids.size)
+            owners = np.fromiter(rels.keys(), np.int64, len(rels))
+            counts = np.fromiter(map(len, rels.values()), np.int64, len(rels))
+            others = np.fromiter(chain.from_iterable(rels.values()), np.int64, int(counts.sum()))
+            weight = np.fromiter(map(RELATION_WEIGHTS.get, chain.from_iterable(map(dict.values, rels.values())), repeat(0.0)),
+                                 float, others.size)
+            src = np.repeat(np.where(owners < lookup.size, lookup[np.minimum(owners, lookup.size - 1)], -1), counts)
+            dst = np.where(others < lookup.size, lookup[np.minimum(others, lookup.size - 1)], -1)
+            ok = (src >= 0) & (dst >= 0)
+            src, dst, weight = src[ok], dst[ok], weight[ok]
+            starts = np.flatnonzero(np.r_[True, src[1:] != src[:-1]]) if src.size else np.zeros(0, np.int64)
+            group = np.repeat(np.arange(starts.size), np.diff(np.r_[starts, src.size]))
+            self.edges = (src, dst, weight, starts, group)
+            self.edges_version = world.relations_version
+        return self.edges
+
+    def election(self, world):
+        # Каждый голосует за самого симпатичного знакомого (друг > нейтральный, с шумом);
+        # у кого только враги или нет отношений — случайный голос, как раньше
+        n = len(self.records)
+        if not n:
+            return None, 0
+        src, dst, weight, starts, group = self.relation_edges(world)
+        choice = self.rng.integers(0, n, n)
+        if src.size:
+            score = weight + self.rng.random(src.size) * ELECTION_NOISE
+            best = np.maximum.reduceat(score, starts)  # Максимум по рёбрам каждого избирателя
+            pick = np.empty(starts.size, np.int64)
+            hit = np.flatnonzero(score == best[group])
+            pick[group[hit]] = dst[hit]
+            keep = best >= 0
+            choice[src[starts][keep]] = pick[keep]
+        votes = np.bincount(choice, minlength=n)
+        winner = int(votes.argmax())
+        return self.records[winner], int(votes[winner])
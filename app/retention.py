@@ -0,0 +1,124 @@
+import asyncio
+import gzip
+import json
+import logging
+import os
+import time
+from datetime import datetime
+from sqlalchemy import select, delete, func
+from .db import AsyncSessionLocal, BASE_DIR
+from .models import Message, Event
+
+logger = logging.getLogger(__name__)
+
+RETENTION_INTERVAL = float(os.environ.get('RETENTION_INTERVAL', 3600))  # Секунд между проходами
+RETENTION_MESSAGES_PER_NPC = int(os.environ.get('RETENTION_MESSAGES_PER_NPC', 200))  # Сообщений на NPC в горячей таблице
+RETENTION_EVENTS = int(os.environ.get('RETENTION_EVENTS', 5000))  # Событий в горячей таблице
+RETENTION_BATCH = int(os.environ.get('RETENTION_BATCH', 5000))  # Строк за одну транзакцию
+ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR', os.path.join(BASE_DIR, 'archive'))
+
+def write_archive(kind: str, rows: list) -> str:
+    # Сначала gzip JSONL на диск, только потом удаление из горячей таблицы
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    stamp = datetime.utcnow().strftime('%Y%m%d-%H%M%S')
+    path = os.path.join(ARCHIVE_DIR, f"{kind}-{stamp}-{rows[0]['id']}-{rows[-1]['id']}.jsonl.gz")
+    with open(path, 'wb') as raw:
+        with gzip.GzipFile(fileobj=raw, mode='wb') as f:
+            for row in rows:
+                f.write((json.dumps(row, ensure_ascii=False) + '\n').encode('utf-8'))
+        raw.flush()
+        os.fsync(raw.fileno())
+    return path
+
+class RetentionJob:
+    """Переносит старые messages/events в сжатые архивы, чтобы горячие таблицы не росли."""
+
+    def __init__(self, interval: float = RETENTION_INTERVAL, messages_per_npc: int = RETENTION_MESSAGES_PER_NPC,
+                 events: int = RETENTION_EVENTS, batch: int = RETENTION_BATCH):
+        self.interval = interval
+        self.messages_per_npc = messages_per_npc
+        self.events = events
+        self.batch = batch
+        self.task = None
+        self.runs = 0
+        self.archived = {"messages": 0, "events": 0}
+        self.last_run_ms = 0.0
+
+    async def _old_message_ids(self, db):
+        # Всё, что старше последних messages_per_npc сообщений каждого NPC
+        ranked = select(
+            Message.id,
+            func.row_number().over(partition_by=Message.npc_id, order_by=Message.id.desc()).label('rn'),
+        ).subquery()
+        q = select(ranked.c.id).where(ranked.c.rn > self.messages_per_npc).order_by(ranked.c.id).limit(self.batch)
+        return (await db.execute(q)).scalars().all()
+
+    async def _old_event_ids(self, db):
+        cutoff = (await db.execute(select(Event.id).order_by(Event.id.desc()).offset(self.events).limit(1))).scalar()
+        if cutoff is None:
+            return []
+        return (await db.execute(select(Event.id).where(Event.id <= cutoff).order_by(Event.id).limit(self.batch))).scalars().all()
+
+    async def archive_messages(self) -> int:
+        total = 0
+        while True:
+            async with AsyncSessionLocal() as db:
+                ids = await self._old_message_ids(db)
+                if not ids:
+                    return total
+                rows = (await db.execute(select(Message).where(Message.id.in_(ids)).order_by(Message.id))).scalars().all()
+                data = [{"id": m.id, "npc_id": m.npc_id, "role": m.role, "content": m.content} for m in rows]
+                await asyncio.to_thread(write_archive, 'messages', data)
+                await db.execute(delete(Message).where(Message.id.in_(ids)))
+                await db.commit()
+            total += len(ids)
+            if len(ids) < self.batch:
+                return total
+
+    async def archive_events(self) -> int:
+        total = 0
+        while True:
+            async with AsyncSessionLocal() as db:
+                ids = await self._old_event_ids(db)
+                if not ids:
+                    return total
+                rows = (await db.execute(select(Event).where(Event.id.in_(ids)).order_by(Event.id))).scalars().all()
+                data = [{"id": e.id, "title": e.title, "content": e.content, "ts": e.ts} for e in rows]
+                await asyncio.to_thread(write_archive, 'events', data)
+                await db.execute(delete(Event).where(Event.id.in_(ids)))
+                await db.commit()
+            total += len(ids)
+            if len(ids) < self.batch:
+                return total
+
+    async def run_once(self):
+        started = time.perf_counter()
+        messages = await self.archive_messages()
+        events = await self.archive_events()
+        self.archived["messages"] += messages
+        self.archived["events"] += events
+        self.runs += 1
+        self.last_run_ms = round((time.perf_counter() - started) * 1000, 2)
+        if messages or events:
+            logger.info(f"Архивировано: сообщений {messages}, событий {events}")
+
+    async def loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.run_once()
+            except Exception as e:
+                logger.error(f"Ошибка архивации: {e}")
+
+    def start(self):
+        self.task = asyncio.create_task(self.loop())
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    def stats(self):
+        return {"runs": self.runs, "archived": dict(self.archived), "last_run_ms": self.last_run_ms}
+
+retention = RetentionJob()
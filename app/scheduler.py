@@ -0,0 +1,45 @@
+import heapq
+import time
+from collections import deque
+
+class TickScheduler:
+    """Очередь NPC по времени следующего действия (min-heap) + метрики тиков."""
+
+    def __init__(self, max_batch: int = 500, window: int = 60):
+        self.max_batch = max_batch
+        self.queue = []  # (due, npc_id)
+        self.ticks = 0
+        self.npcs_processed = 0
+        self.history = deque(maxlen=window)  # (wall_ts, npcs, duration) последних тиков
+
+    def __len__(self):
+        return len(self.queue)
+
+    def schedule(self, npc_id: int, due: float):
+        heapq.heappush(self.queue, (due, npc_id))
+
+    def next_due(self):
+        return self.queue[0][0] if self.queue else None
+
+    def pop_due(self, now: float):
+        due = []
+        while self.queue and self.queue[0][0] <= now and len(due) < self.max_batch:
+            due.append(heapq.heappop(self.queue)[1])
+        return due
+
+    def record_tick(self, npcs: int, duration: float):
+        self.ticks += 1
+        self.npcs_processed += npcs
+        self.history.append((time.monotonic(), npcs, duration))
+
+    def stats(self):
+        h = list(self.history)
+        span = h[-1][0] - h[0][0] if len(h) > 1 else 0.0
+        return {
+            "ticks": self.ticks,
+            "npcs_processed": self.npcs_processed,
+            "queued": len(self.queue),
+            "ticks_per_second": round((len(h) - 1) / span, 3) if span else 0.0,
+            "npcs_per_tick": round(sum(n for _, n, _ in h) / len(h), 2) if h else 0.0,
+            "avg_tick_ms": round(sum(d for _, _, d in h) / len(h) * 1000, 2) if h else 0.0,
+        }
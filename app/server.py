@@ -1,44 +1,159 @@
-import json, os
+import os, random
 import asyncio
 import logging
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+import time
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import JSONResponse, FileResponse, PlainTextResponse
 from sqlalchemy.sql import text
-from .db import init_db, SessionLocal
-from .models import NPC, Event, Message, Weather
+from .db import init_db, AsyncSessionLocal, engine
 from .chat_ws import manager
+from .map_state import map_state
+from .spatial import npc_index, parse_rect
+from .world import world
+from .cluster import cluster
+from .retention import retention
+from .memory import memory
 from .npc_manager import NPCManager
+from . import metrics
+from .metrics import registry, topic_label, WS_ACTION
+from .ai import generate_reply, stream_reply, close_cache, stats as ai_stats, jobs as ai_jobs
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 app = FastAPI()
 app.add_middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'])
-
-init_db()
+app.add_middleware(metrics.MetricsMiddleware)
 
 async def broadcaster(topic, payload):
-    await manager.broadcast(topic, {"type": topic, "data": payload})
+    # События симуляции идут через шину: каждый воркер рассылает их своим сокетам
+    await cluster.bus.publish('events', {"topic": topic, "payload": payload})
+
+def follow(topic, payload):
+    # Ведомый воркер держит копию мира по событиям ведущего (остальное догоняет on_sync)
+    if topic == 'news':
+        world.events.append(payload)
+        return
+    npc = world.npcs.get(payload.get('id'))
+    if npc is None:
+        return
+    if topic == 'map_update':
+        npc.apply(**payload)
+        npc_index.move(npc.id, npc.x, npc.y)
+    elif topic == 'state_update':
+        npc.apply(**payload['state'])
+
+async def on_event(msg):
+    topic, payload = msg['topic'], msg['payload']
+    if not cluster.is_leader:
+        follow(topic, payload)
+    if topic == 'map_update':  # Движения уходят пачками через map_state
+        map_state.update(payload['id'], payload)
+        return
+    if topic == 'state_update':
+        map_state.update_state(payload['id'], payload['state'])
+    # Догнавшему клиенту (after) не дублируем то, что он уже получил из кольца
+    where = (lambda meta: payload['id'] > meta.get('after', 0)) if topic == 'news' else None
+    await manager.broadcast(topic, {"type": topic, "data": payload}, where)
+
+async def on_sync(changes):
+    # Изменения из write-behind ведущего: деньги, бизнес, отношения, погода
+    if cluster.is_leader:
+        return
+    world.apply_changes(changes)
+    for row in changes.get('npcs', ()):
+        npc = world.npcs.get(row['id'])
+        if npc is not None and ('x' in row or 'y' in row):
+            npc_index.move(npc.id, npc.x, npc.y)
+
+async def publish_sync(changes):
+    await cluster.bus.publish('sync', changes)
+
+async def apply_write(op, data):
+    # Все записи в мир делает только ведущий: у него id сообщений/событий и write-behind
+    if op == 'message':
+        world.add_message(data['npc_id'], data['role'], data['content'], ref=data.get('ref'))
+    elif op == 'move':
+        npc = world.npcs.get(data['id'])
+        if npc is None:
+            return
+        npc.x, npc.y, npc.location = data['x'], data['y'], data['location']
+        npc_index.move(npc.id, npc.x, npc.y)
+        npc_manager.population.sync(npc)
+        await broadcaster('map_update', data)
+    elif op == 'law':
+        await broadcaster('news', world.add_event("Новый закон", f"Мэр объявил: {data['law']}."))
+
+async def submit(op, **data):
+    if cluster.is_leader:
+        await apply_write(op, data)
+    else:
+        if op == 'message':  # До сброса ведущего история на этом воркере показывает и свою копию
+            data['ref'] = world.add_unsynced(data['npc_id'], data['role'], data['content'])
+        await cluster.bus.publish('writes', {"op": op, "data": data})
+
+async def on_write(msg):
+    if cluster.is_leader:
+        await apply_write(msg['op'], msg['data'])
 
 npc_manager = NPCManager(broadcaster)
+background = []  # Служебные задачи сервера
+cluster.bus.subscribe('events', on_event)
+cluster.bus.subscribe('sync', on_sync)
+cluster.bus.subscribe('writes', on_write)
+manager.attach(cluster.bus)
+
+registry.callback('sim_ticks_total', 'Тиков симуляции', lambda: npc_manager.scheduler.ticks, kind='counter')
+registry.callback('sim_npcs_processed_total', 'Действий NPC обработано', lambda: npc_manager.scheduler.npcs_processed, kind='counter')
+registry.callback('sim_queued_npcs', 'NPC в очереди планировщика', lambda: len(npc_manager.scheduler.queue))
+registry.callback('sim_narrations', 'Фоновых AI-описаний действий NPC в полёте', lambda: len(npc_manager.narrations))
+registry.callback('sim_narrations_shed_total', 'Действий NPC без AI-описания: превышен NPC_NARRATION_MAX',
+                  lambda: npc_manager.narration_shed, kind='counter')
+registry.callback('world_dirty_records', 'Изменений, ждущих сброса в БД', world.dirty_count)
+registry.callback('world_flush_errors_total', 'Неудачных сбросов мира в БД', lambda: world.flush_errors, kind='counter')
+
+async def start_simulation(promoted: bool):
+    # Вызывается в воркере, который взял блокировку ведущего
+    if promoted:
+        await world.load()  # Был ведомым: перечитываем БД, там последний сброс прежнего ведущего
+        map_state.load()
+    world.on_flush = publish_sync
+    await npc_manager.start()
+    retention.start()
 
 @app.on_event('startup')
 async def startup():
-    db = SessionLocal()
-    try:
-        db.execute(text("UPDATE messages SET role = 'user' WHERE role = 'npc'"))
-        db.commit()
-        logger.info("Успешно мигрирована таблица сообщений")
-    except Exception as e:
-        logger.error(f"Ошибка миграции таблицы сообщений: {e}")
-    finally:
-        db.close()
-    await npc_manager.start()
+    async with cluster.init_lock():  # Воркеры готовят БД по очереди
+        await init_db()
+        async with AsyncSessionLocal() as db:
+            try:
+                await db.execute(text("UPDATE messages SET role = 'user' WHERE role = 'npc'"))
+                await db.commit()
+                logger.info("Успешно мигрирована таблица сообщений")
+            except Exception as e:
+                logger.error(f"Ошибка миграции таблицы сообщений: {e}")
+        await npc_manager.seed()
+    await world.load()
+    world.start()
+    manager.set_locations(world.locations)
+    map_state.load()
+    map_state.start()
+    background.append(asyncio.create_task(metrics.lag_monitor()))
+    await cluster.start(start_simulation)
 
 @app.on_event('shutdown')
-def shutdown():
+async def shutdown():
     npc_manager.stop()
+    retention.stop()
+    memory.stop()
+    for t in background:
+        t.cancel()
+    map_state.stop()
+    await world.stop()
+    await cluster.stop()  # После финального сброса: новый ведущий прочитает актуальную БД
+    await close_cache()
+    await engine.dispose()
 
 @app.get('/')
 @app.head('/')
@@ -50,116 +165,158 @@ async def favicon():
     return FileResponse("static/favicon.ico") if os.path.exists("static/favicon.ico") else JSONResponse(status_code=204)
 
 @app.get('/map')
-def get_map():
-    db = SessionLocal()
+async def get_map(since: int = None, x0: float = None, y0: float = None, x1: float = None, y1: float = None):
     try:
-        npcs = db.query(NPC).all()
-        out = [{"id": n.id, "name": n.name, "x": n.x, "y": n.y, "profession": n.profession, "state": n.state} for n in npcs]
-        return out
-    finally:
-        db.close()
+        rect = parse_rect(x0, y0, x1, y1)  # Окно просмотра, если задано
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    if since is not None:  # Только изменения после версии since
+        return map_state.since(since, rect)
+    npcs = world.npcs.values() if rect is None else [world.npcs[i] for i in npc_index.query_rect(*rect) if i in world.npcs]
+    out = [{"id": n.id, "name": n.name, "x": n.x, "y": n.y, "profession": n.profession, "state": n.state} for n in npcs]
+    return out
+
+@app.get('/relations/{npc_id}')
+async def get_relations(npc_id: int):
+    return {str(other_id): kind for other_id, kind in world.relations.get(npc_id, {}).items()}
 
 @app.get('/news')
-def get_news():
-    db = SessionLocal()
-    try:
-        evs = db.query(Event).order_by(Event.id.desc()).limit(50).all()
-        out = [{"title": e.title, "content": e.content, "ts": e.ts} for e in evs]
-        return out
-    finally:
-        db.close()
+async def get_news(before: int = None, limit: int = 50):
+    # Новые первыми; следующая страница: ?before=<id последнего события>
+    return await world.events_page(before, max(1, min(limit, 200)))
 
 @app.get('/chat_history/{npc_id}')
-def get_chat_history(npc_id: int):
-    db = SessionLocal()
-    try:
-        hist = db.query(Message).filter(Message.npc_id == npc_id).order_by(Message.id).all()
-        return [{"role": m.role, "content": m.content} for m in hist]
-    finally:
-        db.close()
+async def get_chat_history(npc_id: int, before: int = None, limit: int = 50):
+    # Последние limit сообщений по порядку; более старые: ?before=<id первого сообщения>
+    hist = await world.recent_messages(npc_id, max(1, min(limit, 200)), before)
+    return [{"id": m.id, "role": m.role, "content": m.content} for m in hist]
 
 @app.get('/weather')
-def get_weather():
-    db = SessionLocal()
-    try:
-        weather = db.query(Weather).first()
-        return {"current": weather.current}
-    finally:
-        db.close()
+async def get_weather():
+    return {"current": world.weather.current}
+
+@app.get('/sim_stats')
+async def get_sim_stats():
+    return {**npc_manager.scheduler.stats(), "narration": npc_manager.narration_stats(), "world": world.stats(), "retention": retention.stats(), "cluster": cluster.stats()}
+
+@app.get('/ws_stats')
+async def get_ws_stats():
+    return manager.stats()
+
+@app.get('/ai_stats')
+async def get_ai_stats():
+    return {**ai_stats.as_dict(), "queue": ai_jobs.stats(), "memory": memory.stats()}
+
+@app.get('/metrics')
+async def get_metrics():
+    return PlainTextResponse(registry.render(), media_type='text/plain; version=0.0.4')
+
+@app.get('/debug/profile')
+async def debug_profile(seconds: float = 5):
+    # Профиль event loop за seconds секунд; включается METRICS_PROFILER=1
+    if not metrics.METRICS_PROFILER:
+        raise HTTPException(status_code=404)
+    return PlainTextResponse(await metrics.profile(seconds))
 
 @app.post('/issue_law')
 async def issue_law(data: dict):
-    law = data.get('law')
-    db = SessionLocal()
-    try:
-        ev = Event(title="Новый закон", content=f"Мэр объявил: {law}.", ts=str(datetime.utcnow()))
-        db.add(ev)
-        db.commit()
-        await broadcaster('news', {"title": ev.title, "content": ev.content, "ts": ev.ts})
-        return {"status": "ok"}
-    finally:
-        db.close()
+    await submit('law', law=data.get('law'))
+    return {"status": "ok"}
+
+async def stream_chat(topic, npc, system, history, text):
+    # Токены уходят chat_delta по мере генерации, целиком ответ — финальным chat
+    started = time.perf_counter()
+    parts = []
+    async for token in stream_reply(system, history, text):
+        parts.append(token)
+        await manager.publish(topic, {"type": "chat_delta", "data": {"npc_id": npc.id, "from": "npc", "text": token}})
+    reply = ''.join(parts).strip()
+    await submit('message', npc_id=npc.id, role='user', content=f"NPC_{npc.name}: {reply}")
+    await manager.publish(topic, {"type": "chat", "data": {"npc_id": npc.id, "from": "npc", "text": reply}})
+    WS_ACTION.observe(time.perf_counter() - started, 'npc', 'message')
+
+async def replay_news(conn, since: int):
+    # Подписка уже есть, писатель на паузе: отдаём (since, upto] и отпускаем живые кадры с id > upto.
+    # upto берём до первого await, иначе событие между подпиской и снимком потеряется
+    upto = world.events[-1]['id'] if world.events else since
+    conn.meta['after'] = upto
+    events, gap = await world.events_since(since, upto)
+    if gap:  # Отстал сильнее лимита — клиенту стоит перечитать /news
+        await conn.send(conn.encode({"type": "news_gap", "data": {"since": since, "from": events[0]['id']}}))
+    for ev in events:
+        await conn.send(conn.encode({"type": "news", "data": ev}))
+    gap = None
+    if conn.held_dropped:  # Живых событий за время выдачи пришло больше WS_HELD_QUEUE_SIZE — старшие вытеснены
+        first = conn.first_key()  # ('news', id) самого раннего уцелевшего
+        gap = conn.encode({"type": "news_gap", "data": {"since": upto, "from": first[1] if first else None}})
+    conn.release(gap)  # Без await после проверки: новых вытеснений между ней и release не будет
 
 @app.websocket('/ws/{topic}')
 async def websocket_endpoint(websocket: WebSocket, topic: str):
-    await manager.connect(topic, websocket)
+    meta = {}
+    stream_task = None
+    since = None
+    if topic == 'news':  # Переподключение без дыр: /ws/news?since=<id последнего полученного события>
+        try:
+            since = int(websocket.query_params['since'])
+        except (KeyError, ValueError):
+            since = None
+    if topic == 'map_update':  # Клиент выбирает частоту и регион: /ws/map_update?rate=10&x0=0&y0=0&x1=400&y1=200
+        params = websocket.query_params
+        topic = map_state.topic_for(params.get('rate'))
+        try:
+            meta['region'] = parse_rect(params.get('x0'), params.get('y0'), params.get('x1'), params.get('y1'))
+        except ValueError:
+            meta['region'] = None
+    conn = await manager.connect(topic, websocket, held=since is not None, **meta)
     try:
+        if since is not None:
+            await replay_news(conn, since)
+        if topic.startswith('map_update:'):
+            await manager.send_personal(websocket, {"type": "map_snapshot", "data": map_state.snapshot(meta.get('region'))})
         while True:
-            data = await websocket.receive_text()
-            try:
-                msg = json.loads(data)
-            except Exception:
-                msg = {}
+            msg = await conn.receive()  # JSON-текст или MessagePack — как договорились при подключении
             if topic.startswith('npc_') and msg.get('action') == 'message':
                 npc_id = int(topic.split('_', 1)[1])
                 text = msg.get('text', '')
-                db = SessionLocal()
-                try:
-                    npc = db.query(NPC).get(npc_id)
-                    if not npc:
-                        await manager.send_personal(websocket, {"type": "error", "data": "Персонаж не найден"})
-                        continue
-                    system = f"Ты {npc.name}, {npc.personality}. Отвечай коротко и в характере. Учитывай отношения и погоду."
-                    hist = db.query(Message).filter(Message.npc_id == npc_id).order_by(Message.id.desc()).limit(10).all()
-                    history = [{'role': 'user' if m.role == 'npc' else m.role, 'content': m.content} for m in reversed(hist)]
-                    logger.debug(f"WebSocket история для NPC {npc_id}: {history}")
-                    db.add(Message(npc_id=npc_id, role='user', content=f"Игрок: {text}"))
-                    db.commit()
-                    from .ai import generate_reply
-                    reply = await generate_reply(system, history, text)
-                    db.add(Message(npc_id=npc_id, role='user', content=f"NPC_{npc.name}: {reply}"))
-                    db.commit()
-                    await manager.broadcast(topic, {"type": "chat", "data": {"npc_id": npc_id, "from": "npc", "text": reply}})
-                finally:
-                    db.close()
+                npc = world.npcs.get(npc_id)
+                if not npc:
+                    await manager.send_personal(websocket, {"type": "error", "data": "Персонаж не найден"})
+                    continue
+                if stream_task and not stream_task.done():
+                    await stream_task  # Один ответ за раз: следующий видит предыдущий в истории
+                system = f"Ты {npc.name}, {npc.personality}. Отвечай коротко и в характере. Учитывай отношения и погоду."
+                history = await memory.context(npc, system, text)  # Содержание старого + последние реплики
+                logger.debug(f"WebSocket история для NPC {npc_id}: {history}")
+                await submit('message', npc_id=npc_id, role='user', content=f"Игрок: {text}")
+                # Стрим в отдельной задаче, чтобы цикл приёма заметил закрытие сокета
+                stream_task = asyncio.create_task(stream_chat(topic, npc, system, history, text))
             elif topic.startswith('npc_') and msg.get('action') == 'command':
                 npc_id = int(topic.split('_', 1)[1])
                 command = msg.get('text', '')
-                db = SessionLocal()
-                try:
-                    npc = db.query(NPC).get(npc_id)
-                    if not npc:
-                        await manager.send_personal(websocket, {"type": "error", "data": "Персонаж не найден"})
-                        continue
-                    system = f"Ты {npc.name}. Выполни команду: {command}. Учитывай личность и состояние."
-                    history = []
-                    reply = await generate_reply(system, history, command)
-                    if 'go to' in command.lower() or command == 'tell about city':
-                        loc_name = command.split('to')[-1].strip() if 'go to' in command.lower() else None
-                        if loc_name:
-                            loc = db.query(Location).filter_by(name=loc_name).first()
-                            if loc:
-                                npc.x = random.uniform(loc.x_min, loc.x_max)
-                                npc.y = random.uniform(loc.y_min, loc.y_max)
-                                npc.state['location'] = loc_name
-                                db.commit()
-                                await broadcaster('map_update', {"id": npc.id, "x": npc.x, "y": npc.y, "location": loc_name})
-                    db.add(Message(npc_id=npc_id, role='user', content=f"Команда: {reply}"))
-                    db.commit()
-                    await manager.broadcast(topic, {"type": "command", "data": {"npc_id": npc_id, "reply": reply}})
-                finally:
-                    db.close()
+                npc = world.npcs.get(npc_id)
+                if not npc:
+                    await manager.send_personal(websocket, {"type": "error", "data": "Персонаж не найден"})
+                    continue
+                started = time.perf_counter()
+                system = f"Ты {npc.name}. Выполни команду: {command}. Учитывай личность и состояние."
+                history = []
+                reply = await generate_reply(system, history, command)
+                if 'go to' in command.lower() or command == 'tell about city':
+                    loc_name = command.split('to')[-1].strip() if 'go to' in command.lower() else None
+                    loc = world.location(loc_name) if loc_name else None
+                    if loc:
+                        await submit('move', id=npc.id, x=random.uniform(loc.x_min, loc.x_max),
+                                     y=random.uniform(loc.y_min, loc.y_max), location=loc_name)
+                await submit('message', npc_id=npc_id, role='user', content=f"Команда: {reply}")
+                await manager.publish(topic, {"type": "command", "data": {"npc_id": npc_id, "reply": reply}})
+                WS_ACTION.observe(time.perf_counter() - started, 'npc', 'command')
             else:
-                await manager.send_personal(websocket, {"type": "echo", "data": msg})
+                with WS_ACTION.time(topic_label(topic), 'echo'):
+                    await manager.send_personal(websocket, {"type": "echo", "data": msg})
     except WebSocketDisconnect:
+        pass
+    finally:
+        if stream_task and not stream_task.done():
+            stream_task.cancel()  # Сокет закрыт посреди генерации — прерываем поток OpenAI
         manager.disconnect(topic, websocket)
@@ -0,0 +1,105 @@
+import heapq
+import math
+import os
+from collections import defaultdict
+
+SPATIAL_CELL = float(os.environ.get('SPATIAL_CELL', 50))  # Размер ячейки сетки
+
+class SpatialGrid:
+    """Равномерная сетка: npc_id -> (x, y), поиск по прямоугольнику и k ближайших."""
+
+    def __init__(self, cell: float = SPATIAL_CELL):
+        self.cell = cell
+        self.cells = defaultdict(set)  # (cx, cy) -> {npc_id}
+        self.pos = {}  # npc_id -> (x, y)
+
+    def __len__(self):
+        return len(self.pos)
+
+    def _key(self, x: float, y: float):
+        return (int(x // self.cell), int(y // self.cell))
+
+    def move(self, npc_id: int, x: float, y: float):
+        # Вставка или перемещение
+        old = self.pos.get(npc_id)
+        new_key = self._key(x, y)
+        if old is not None:
+            old_key = self._key(*old)
+            if old_key != new_key:
+                self._discard(old_key, npc_id)
+                self.cells[new_key].add(npc_id)
+        else:
+            self.cells[new_key].add(npc_id)
+        self.pos[npc_id] = (x, y)
+
+    def remove(self, npc_id: int):
+        old = self.pos.pop(npc_id, None)
+        if old is not None:
+            self._discard(self._key(*old), npc_id)
+
+    def _discard(self, key, npc_id):
+        bucket = self.cells.get(key)
+        if bucket is not None:
+            bucket.discard(npc_id)
+            if not bucket:
+                del self.cells[key]
+
+    def clear(self):
+        self.cells.clear()
+        self.pos.clear()
+
+    def query_rect(self, x0: float, y0: float, x1: float, y1: float):
+        x0, x1 = min(x0, x1), max(x0, x1)
+        y0, y1 = min(y0, y1), max(y0, y1)
+        cx0, cy0 = self._key(x0, y0)
+        cx1, cy1 = self._key(x1, y1)
+        out = []
+        if (cx1 - cx0 + 1) * (cy1 - cy0 + 1) > len(self.cells):
+            keys = [k for k in self.cells if cx0 <= k[0] <= cx1 and cy0 <= k[1] <= cy1]  # Огромный прямоугольник
+        else:
+            keys = [(cx, cy) for cx in range(cx0, cx1 + 1) for cy in range(cy0, cy1 + 1) if (cx, cy) in self.cells]
+        for key in keys:
+            for npc_id in self.cells[key]:
+                x, y = self.pos[npc_id]
+                if x0 <= x <= x1 and y0 <= y <= y1:
+                    out.append(npc_id)
+        return out
+
+    def nearest(self, x: float, y: float, k: int = 1, exclude=None, max_radius: float = None):
+        # Расширяем кольца ячеек, пока k-й кандидат не окажется ближе следующего кольца
+        if not self.cells:
+            return []
+        ccx, ccy = self._key(x, y)
+        xs = [key[0] for key in self.cells]
+        ys = [key[1] for key in self.cells]
+        max_ring = max(abs(ccx - min(xs)), abs(ccx - max(xs)), abs(ccy - min(ys)), abs(ccy - max(ys)))
+        if max_radius is not None:
+            max_ring = min(max_ring, int(math.ceil(max_radius / self.cell)))
+        best = []  # max-heap через (-dist, id)
+        for r in range(max_ring + 1):
+            if len(best) >= k and -best[0][0] <= (r - 1) * self.cell:
+                break
+            for cx in range(ccx - r, ccx + r + 1):
+                for cy in (range(ccy - r, ccy + r + 1) if abs(cx - ccx) == r else (ccy - r, ccy + r)):
+                    for npc_id in self.cells.get((cx, cy), ()):
+                        if npc_id == exclude:
+                            continue
+                        px, py = self.pos[npc_id]
+                        d = math.hypot(px - x, py - y)
+                        if max_radius is not None and d > max_radius:
+                            continue
+                        if len(best) < k:
+                            heapq.heappush(best, (-d, npc_id))
+                        elif d < -best[0][0]:
+                            heapq.heapreplace(best, (-d, npc_id))
+        return [npc_id for _, npc_id in sorted(best, key=lambda t: -t[0])]
+
+def parse_rect(x0=None, y0=None, x1=None, y1=None):
+    if None in (x0, y0, x1, y1):
+        return None
+    rect = (float(x0), float(y0), float(x1), float(y1))
+    if not all(map(math.isfinite, rect)):  # inf ломает _key(), nan — любые сравнения
+        raise ValueError(f"Границы региона должны быть конечными числами: {rect}")
+    return rect
+
+npc_index = SpatialGrid()
@@ -0,0 +1,353 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from datetime import datetime
+from sqlalchemy import select, update, func
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from .db import AsyncSessionLocal
+from .models import NPC, Message, Event, Location, Weather, Relation
+
+logger = logging.getLogger(__name__)
+
+WORLD_MAX_FLUSH_LAG = float(os.environ.get('WORLD_MAX_FLUSH_LAG', 5))  # Секунд, сколько изменения могут жить только в памяти
+WORLD_FLUSH_DIRTY = int(os.environ.get('WORLD_FLUSH_DIRTY', 500))  # Сбросить сразу, если накопилось столько грязных записей
+WORLD_EVENTS_RING = int(os.environ.get('WORLD_EVENTS_RING', 1000))  # Последние события в памяти (/news и догон /ws/news)
+WORLD_NEWS_REPLAY = int(os.environ.get('WORLD_NEWS_REPLAY', 500))  # Максимум событий, которые догоняет переподключившийся клиент
+
+class Record:
+    """Запись мира в памяти: присваивание поля помечает её грязной для write-behind."""
+    model = None
+    FIELDS = ()
+
+    def __init__(self, world, **values):
+        object.__setattr__(self, '_world', world)
+        for name in self.FIELDS:
+            object.__setattr__(self, name, values.get(name))
+
+    def __setattr__(self, name, value):
+        if getattr(self, name, None) == value:
+            return
+        object.__setattr__(self, name, value)
+        if name in self.FIELDS:
+            self._world.mark_dirty(self, name)
+
+    def apply(self, **values):
+        # Изменения от ведущего воркера: в копии мира, без пометки грязной
+        for name, value in values.items():
+            if name in self.FIELDS:
+                object.__setattr__(self, name, value)
+
+    @classmethod
+    def from_row(cls, world, row):
+        return cls(world, **{name: getattr(row, name) for name in cls.FIELDS})
+
+class NPCRecord(Record):
+    model = NPC
+    FIELDS = ('id', 'name', 'profession', 'personality', 'mood', 'money', 'location', 'business', 'x', 'y')
+
+    @property
+    def state(self):
+        return {"mood": self.mood, "money": self.money, "location": self.location, "business": self.business}
+
+class WeatherRecord(Record):
+    model = Weather
+    FIELDS = ('id', 'current')
+
+def event_payload(ev) -> dict:
+    return {"id": ev.id, "title": ev.title, "content": ev.content, "ts": ev.ts}
+
+class World:
+    """Авторитетное состояние города, пока сервер работает; SQLite догоняет через write-behind."""
+
+    def __init__(self, max_flush_lag: float = WORLD_MAX_FLUSH_LAG, flush_dirty: int = WORLD_FLUSH_DIRTY, events_ring: int = WORLD_EVENTS_RING):
+        self.max_flush_lag = max_flush_lag
+        self.flush_dirty = flush_dirty
+        self.npcs = {}  # id -> NPCRecord
+        self.locations = []  # Location (только чтение)
+        self.weather = None
+        self.relations = {}  # npc_id -> {other_id: kind}
+        self.relations_version = 0  # Растёт при каждом изменении отношений (кэши поверх relations)
+        self.events = deque(maxlen=events_ring)  # Последние события для /news
+        self.dirty = {}  # (model, id) -> (record, {поля})
+        self.dirty_relations = set()  # (npc_id, other_id)
+        self.pending = []  # Новые Message/Event
+        self.flushing = []  # Пачка pending, которую сейчас пишет flush(): читается, пока не закоммичена
+        self.refs = {}  # id сообщения -> ref ведомого, приславшего его; после сброса уходит ведомым в on_flush
+        self.unsynced = {}  # ref -> (Message без id, время): отправлено с этого ведомого, ведущий ещё не сбросил
+        self.unsynced_seq = 0
+        self.next_ids = {Message: 1, Event: 1}  # id выдаются в памяти, чтобы курсоры работали до сброса в БД
+        self.on_flush = None  # async callback(changes) после успешного сброса — репликация на ведомых
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.stopping = False
+        self.loaded = False
+        self.flushes = 0
+        self.rows_written = 0
+        self.last_flush_ms = 0.0
+        self.flush_errors = 0
+
+    async def load(self):
+        async with AsyncSessionLocal() as db:
+            self.npcs = {n.id: NPCRecord.from_row(self, n) for n in (await db.execute(select(NPC))).scalars()}
+            self.locations = list((await db.execute(select(Location))).scalars())
+            self.weather = WeatherRecord.from_row(self, (await db.execute(select(Weather).limit(1))).scalar())
+            self.relations = {}
+            for npc_id, other_id, kind in (await db.execute(select(Relation.npc_id, Relation.other_id, Relation.kind))).all():
+                self.relations.setdefault(npc_id, {})[other_id] = kind
+            self.relations_version += 1
+            evs = (await db.execute(select(Event).order_by(Event.id.desc()).limit(self.events.maxlen))).scalars().all()
+            for model in self.next_ids:
+                self.next_ids[model] = ((await db.execute(select(func.max(model.id)))).scalar() or 0) + 1
+        self.events.clear()
+        self.unsynced.clear()  # Всё, что ведущий успел сбросить, уже в БД
+        for ev in reversed(evs):
+            self.events.append(event_payload(ev))
+        self.loaded = True
+        logger.info(f"Мир загружен: {len(self.npcs)} NPC, {len(self.locations)} локаций")
+
+    def location(self, name: str):
+        for loc in self.locations:
+            if loc.name == name:
+                return loc
+        return None
+
+    def relation(self, npc_id: int, other_id: int) -> str:
+        return self.relations.get(npc_id, {}).get(other_id, 'neutral')
+
+    def set_relation(self, npc_id: int, other_id: int, kind: str):
+        rels = self.relations.setdefault(npc_id, {})
+        if rels.get(other_id) == kind:
+            return
+        rels[other_id] = kind
+        self.relations_version += 1
+        self.dirty_relations.add((npc_id, other_id))
+        self._maybe_wake()
+
+    def _next_id(self, model) -> int:
+        value = self.next_ids[model]
+        self.next_ids[model] = value + 1
+        return value
+
+    def add_message(self, npc_id: int, role: str, content: str, ref: str = None):
+        msg = Message(id=self._next_id(Message), npc_id=npc_id, role=role, content=content)
+        self.pending.append(msg)
+        if ref is not None:
+            self.refs[msg.id] = ref
+        self._maybe_wake()
+
+    def add_unsynced(self, npc_id: int, role: str, content: str) -> str:
+        # Ведомый: своя копия сообщения, ушедшего ведущему, пока его сброс не подтвердит запись (apply_changes)
+        self._prune_unsynced()
+        self.unsynced_seq += 1
+        ref = f"{os.getpid()}:{self.unsynced_seq}"
+        self.unsynced[ref] = (Message(id=None, npc_id=npc_id, role=role, content=content), time.monotonic())
+        return ref
+
+    def _prune_unsynced(self):
+        # Ведущий сбрасывает не реже max_flush_lag; что ждёт дольше десяти интервалов — потерялось по дороге
+        deadline = time.monotonic() - self.max_flush_lag * 10
+        while self.unsynced:
+            ref, (_, at) = next(iter(self.unsynced.items()))
+            if at > deadline:
+                break
+            del self.unsynced[ref]
+
+    def unsynced_messages(self, npc_id: int):
+        self._prune_unsynced()
+        return [m for m, _ in self.unsynced.values() if m.npc_id == npc_id]
+
+    def unflushed(self):
+        # Ещё не в БД: пишущаяся пачка и то, что накопилось после неё
+        return self.flushing + self.pending
+
+    def pending_messages(self, npc_id: int, before: int = None):
+        return [m for m in self.unflushed() if isinstance(m, Message) and m.npc_id == npc_id and (before is None or m.id < before)]
+
+    async def recent_messages(self, npc_id: int, limit: int = 10, before: int = None):
+        # Страница по ключу (npc_id, id): то, что уже в БД, плюс ещё не сброшенное
+        # Несброшенное снимаем до запроса: сброс, закоммиченный во время запроса, иначе выпал бы из обоих
+        pending = self.pending_messages(npc_id, before)
+        q = select(Message).where(Message.npc_id == npc_id)
+        if before is not None:
+            q = q.where(Message.id < before)
+        async with AsyncSessionLocal() as db:
+            rows = (await db.execute(q.order_by(Message.id.desc()).limit(limit))).scalars().all()
+        seen = {m.id for m in rows}
+        merged = list(reversed(rows)) + [m for m in pending if m.id not in seen]
+        merged.sort(key=lambda m: m.id)
+        if before is None:
+            merged += self.unsynced_messages(npc_id)  # Без id: новее всего, что этот воркер видит в БД
+        return merged[-limit:]
+
+    async def messages_after(self, npc_id: int, after: int, limit: int = 50):
+        # Вперёд от курсора after, старые первыми: для сжатия истории (app/memory.py)
+        pending = [m for m in self.pending_messages(npc_id) if m.id > after]
+        q = select(Message).where(Message.npc_id == npc_id, Message.id > after).order_by(Message.id).limit(limit)
+        async with AsyncSessionLocal() as db:
+            rows = (await db.execute(q)).scalars().all()
+        seen = {m.id for m in rows}
+        merged = list(rows) + [m for m in pending if m.id not in seen]
+        return sorted(merged, key=lambda m: m.id)[:limit]
+
+    def add_event(self, title: str, content: str) -> dict:
+        ev = Event(id=self._next_id(Event), title=title, content=content, ts=str(datetime.utcnow()))
+        self.pending.append(ev)
+        payload = event_payload(ev)
+        self.events.append(payload)
+        self._maybe_wake()
+        return payload
+
+    async def events_page(self, before: int = None, limit: int = 50):
+        # Новые первыми; из кольца в памяти, а что в него не влезло — из БД по ключу id
+        page = [e for e in reversed(self.events) if before is None or e['id'] < before][:limit]
+        if len(page) < limit:
+            cursor = page[-1]['id'] if page else before
+            q = select(Event)
+            if cursor is not None:
+                q = q.where(Event.id < cursor)
+            async with AsyncSessionLocal() as db:
+                rows = (await db.execute(q.order_by(Event.id.desc()).limit(limit - len(page)))).scalars().all()
+            page += [event_payload(ev) for ev in rows]
+        return page
+
+    async def events_since(self, since: int, upto: int, limit: int = WORLD_NEWS_REPLAY):
+        # События (since, upto], старые первыми; id — номер в общей последовательности.
+        # Второе значение True — пропущенного больше limit, отдаём только последние limit
+        ring = [e for e in self.events if since < e['id'] <= upto]
+        if self.events and self.events[0]['id'] <= since + 1:
+            return ring[-limit:], len(ring) > limit
+        # since вытеснен из кольца: добираем из БД и ещё не сброшенного (снимок — до запроса)
+        pending = [event_payload(ev) for ev in self.unflushed() if isinstance(ev, Event) and since < ev.id <= upto]
+        async with AsyncSessionLocal() as db:
+            rows = (await db.execute(select(Event).where(Event.id > since, Event.id <= upto)
+                                     .order_by(Event.id.desc()).limit(limit + 1))).scalars().all()
+        merged = {ev.id: event_payload(ev) for ev in rows}
+        merged.update((e['id'], e) for e in pending)
+        merged.update((e['id'], e) for e in ring)
+        events = [merged[i] for i in sorted(merged)]
+        return events[-limit:], len(events) > limit
+
+    def apply_changes(self, changes: dict):
+        # Набор изменений из сброса ведущего (см. on_flush)
+        for row in changes.get('npcs', ()):
+            rec = self.npcs.get(row['id'])
+            if rec is not None:
+                rec.apply(**row)
+        for row in changes.get('weather', ()):
+            if self.weather is not None and self.weather.id == row['id']:
+                self.weather.apply(**row)
+        for row in changes.get('relations', ()):
+            self.relations.setdefault(row['npc_id'], {})[row['other_id']] = row['kind']
+            self.relations_version += 1
+        for ref in changes.get('messages', ()):  # Уже в БД — своя копия больше не нужна
+            self.unsynced.pop(ref, None)
+
+    def mark_dirty(self, record: Record, field: str):
+        key = (record.model, record.id)
+        if key not in self.dirty:
+            self.dirty[key] = (record, set())
+        self.dirty[key][1].add(field)
+        self._maybe_wake()
+
+    def set_column(self, records, field: str, values):
+        # Векторный тик пишет столбец целиком: без сравнения и проверки порога на каждое присваивание
+        dirty = self.dirty
+        for record, value in zip(records, values):
+            object.__setattr__(record, field, value)
+            entry = dirty.get((record.model, record.id))
+            if entry is None:
+                entry = dirty[(record.model, record.id)] = (record, set())
+            entry[1].add(field)
+        self._maybe_wake()
+
+    def dirty_count(self) -> int:
+        return len(self.dirty) + len(self.dirty_relations) + len(self.pending)
+
+    def _maybe_wake(self):
+        if self.dirty_count() >= self.flush_dirty:
+            self.wakeup.set()
+
+    async def flush(self):
+        if not self.dirty_count():
+            return 0
+        started = time.perf_counter()
+        dirty, self.dirty = self.dirty, {}
+        rels, self.dirty_relations = self.dirty_relations, set()
+        pending, self.pending = self.pending, []
+        self.flushing = pending
+        # Значения снимаются до первого await, чтобы тики не меняли их посреди записи
+        by_model = {}
+        for (model, pk), (record, fields) in dirty.items():
+            by_model.setdefault(model, []).append({"id": pk, **{f: getattr(record, f) for f in fields}})
+        rel_rows = [{"npc_id": a, "other_id": b, "kind": self.relations[a][b]} for a, b in rels]
+        try:
+            async with AsyncSessionLocal() as db:
+                for model, rows in by_model.items():
+                    await db.execute(update(model), rows)  # Bulk UPDATE по первичному ключу
+                if rel_rows:
+                    stmt = sqlite_insert(Relation)
+                    stmt = stmt.on_conflict_do_update(index_elements=['npc_id', 'other_id'], set_={"kind": stmt.excluded.kind})
+                    await db.execute(stmt, rel_rows)
+                db.add_all(pending)
+                await db.commit()
+        except BaseException as e:
+            # Возвращаем всё в очередь, попробуем на следующем сбросе; при отмене — тоже, иначе пачка потеряется
+            for key, (record, fields) in dirty.items():
+                self.dirty.setdefault(key, (record, set()))[1].update(fields)
+            self.dirty_relations |= rels
+            self.pending = pending + self.pending
+            self.flushing = []
+            if not isinstance(e, Exception):
+                raise
+            self.flush_errors += 1
+            logger.error(f"Ошибка сброса мира в БД: {e}")
+            return 0
+        self.flushing = []  # Закоммичено: дальше читается из БД
+        written = sum(len(rows) for rows in by_model.values()) + len(rel_rows) + len(pending)
+        synced = [self.refs.pop(m.id) for m in pending if isinstance(m, Message) and m.id in self.refs]
+        self.flushes += 1
+        self.rows_written += written
+        self.last_flush_ms = round((time.perf_counter() - started) * 1000, 2)
+        if self.on_flush is not None:
+            await self.on_flush({"npcs": by_model.get(NPC, []), "weather": by_model.get(Weather, []), "relations": rel_rows,
+                                 "messages": synced})
+        return written
+
+    async def flush_loop(self):
+        while not self.stopping:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=self.max_flush_lag)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            if self.stopping:
+                return
+            await self.flush()
+
+    def start(self):
+        self.stopping = False
+        self.task = asyncio.create_task(self.flush_loop())
+
+    async def stop(self):
+        # Не отменяем цикл посреди сброса: просим выйти и ждём, пока текущий сброс допишет
+        if self.task:
+            self.stopping = True
+            self.wakeup.set()
+            await self.task
+            self.task = None
+        await self.flush()  # Финальный сброс при остановке
+
+    def stats(self):
+        return {
+            "npcs": len(self.npcs),
+            "dirty": self.dirty_count(),
+            "flushes": self.flushes,
+            "rows_written": self.rows_written,
+            "last_flush_ms": self.last_flush_ms,
+            "flush_errors": self.flush_errors,
+            "unsynced": len(self.unsynced),
+        }
+
+world = World()
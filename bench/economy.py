@@ -0,0 +1,116 @@
+"""Тик экономики и выборы на всём населении: поштучный Python-путь (как было) против массивов NumPy.
+
+    python -m bench.economy --npcs 1000,10000,50000 --ticks 5
+"""
+import argparse
+import random
+import time
+from types import SimpleNamespace
+from app.population import Population, RELATION_WEIGHTS, DISASTER_CHANCE
+from app.world import World, NPCRecord
+
+LOCATIONS = [
+    SimpleNamespace(name="home", x_min=0, x_max=200, y_min=0, y_max=200),
+    SimpleNamespace(name="shop", x_min=200, x_max=400, y_min=200, y_max=400),
+    SimpleNamespace(name="work", x_min=400, x_max=600, y_min=0, y_max=200),
+    SimpleNamespace(name="park", x_min=600, x_max=800, y_min=200, y_max=400),
+    SimpleNamespace(name="mayor_office", x_min=0, x_max=200, y_min=200, y_max=400),
+]
+
+def build_world(n, relations, seed):
+    rng = random.Random(seed)
+    world = World()
+    world.locations = LOCATIONS
+    for i in range(1, n + 1):
+        loc = rng.choice(LOCATIONS)
+        world.npcs[i] = NPCRecord(world, id=i, name=f"npc{i}", mood="neutral", money=100, location=loc.name,
+                                  business="idea" if rng.random() < 0.3 else None,
+                                  x=rng.uniform(loc.x_min, loc.x_max), y=rng.uniform(loc.y_min, loc.y_max))
+    for i in range(1, n + 1):
+        world.relations[i] = {rng.randint(1, n): rng.choice(['friend', 'neutral', 'enemy']) for _ in range(relations)}
+        world.relations[i].pop(i, None)
+    world.relations_version += 1
+    world.dirty.clear()
+    return world
+
+def per_npc_tick(world, rng):
+    # Логика прежнего act() без AI-описаний: одно действие на NPC в цикле Python
+    for npc in world.npcs.values():
+        action = rng.choice(['move', 'chat', 'work', 'shop', 'business', 'disaster'])
+        if action == 'move':
+            loc = rng.choice(world.locations)
+            npc.x = rng.uniform(loc.x_min, loc.x_max)
+            npc.y = rng.uniform(loc.y_min, loc.y_max)
+            npc.location = loc.name
+        elif action == 'work' and npc.location == 'work':
+            npc.money += rng.randint(10, 20)
+        elif action == 'shop' and npc.location == 'shop':
+            npc.money = max(0, npc.money - rng.randint(5, 15))
+        elif action == 'business' and npc.business:
+            npc.money += rng.randint(5, 10)
+        elif action == 'disaster' and rng.random() < DISASTER_CHANCE:
+            npc.money -= rng.randint(20, 50)
+
+def per_npc_election_random(world, rng):
+    names = [npc.name for npc in world.npcs.values()]
+    votes = {name: 0 for name in names}
+    for _ in names:
+        votes[rng.choice(names)] += 1
+    return max(votes, key=votes.get)
+
+def per_npc_election_weighted(world, rng):
+    # Та же модель голосования, что Population.election, но циклом по избирателям
+    ids = list(world.npcs)
+    votes = dict.fromkeys(ids, 0)
+    for voter in ids:
+        best, best_score = None, -1.0
+        for other, kind in world.relations.get(voter, {}).items():
+            score = RELATION_WEIGHTS.get(kind, 0.0) + rng.random() * 0.5
+            if score > best_score:
+                best, best_score = other, score
+        votes[best if best is not None and best_score >= 0 else rng.choice(ids)] += 1
+    return max(votes, key=votes.get)
+
+def timed(fn, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - started) / repeat * 1000
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--npcs', default='1000,10000,50000')
+    parser.add_argument('--ticks', type=int, default=5)
+    parser.add_argument('--relations', type=int, default=20, help='Отношений на NPC')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    print(f"{'npcs':>7} {'path':>10} {'tick ms':>10} {'npc/s':>12} {'election ms':>12} {'random el. ms':>14}")
+    for n in (int(x) for x in args.npcs.split(',')):
+        world = build_world(n, args.relations, args.seed)
+        rng = random.Random(args.seed)
+
+        def python_tick():
+            per_npc_tick(world, rng)
+            world.dirty.clear()
+
+        tick_ms = timed(python_tick, args.ticks)
+        election_ms = timed(lambda: per_npc_election_weighted(world, rng), 1)
+        random_ms = timed(lambda: per_npc_election_random(world, rng), 1)
+        print(f"{n:>7} {'python':>10} {tick_ms:>10.1f} {n / tick_ms * 1000:>12.0f} {election_ms:>12.1f} {random_ms:>14.1f}")
+
+        pop = Population(seed=args.seed)
+        pop.load(world)
+        everyone = pop.indices(world.npcs)
+
+        def numpy_tick():
+            res = pop.economy(everyone, pop.choose_actions(everyone, 'sunny'))
+            pop.write_back(world, res['changed'], res['move'])
+            world.dirty.clear()
+
+        tick_ms = timed(numpy_tick, args.ticks)
+        pop.relation_edges(world)  # Построение рёбер кэшируется между выборами
+        election_ms = timed(lambda: pop.election(world), 3)
+        print(f"{n:>7} {'numpy':>10} {tick_ms:>10.1f} {n / tick_ms * 1000:>12.0f} {election_ms:>12.1f} {'':>14}")
+
+if __name__ == '__main__':
+    main()
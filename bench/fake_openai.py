@@ -0,0 +1,92 @@
+"""Локальная замена OpenAI chat completions: настраиваемая задержка, ошибки и потоковый режим.
+
+    python -m bench.fake_openai --port 8766 --latency-ms 300 --error-rate 0.02
+    OPENAI_BASE_URL=http://127.0.0.1:8766/v1 OPENAI_API_KEY=bench uvicorn app.server:app
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+FAKE_LATENCY_MS = float(os.environ.get('FAKE_LATENCY_MS', 300))  # До первого токена
+FAKE_JITTER_MS = float(os.environ.get('FAKE_JITTER_MS', 100))
+FAKE_TOKEN_MS = float(os.environ.get('FAKE_TOKEN_MS', 20))  # Между токенами в stream
+FAKE_TOKENS = int(os.environ.get('FAKE_TOKENS', 30))  # Слов в ответе
+FAKE_ERROR_RATE = float(os.environ.get('FAKE_ERROR_RATE', 0))
+
+WORDS = "город погода мэр кофе парк работа деньги новости друг сосед выборы дождь солнце магазин".split()
+
+app = FastAPI()
+counters = {"requests": 0, "streams": 0, "errors": 0}
+
+def _reply_words():
+    n = max(1, int(random.gauss(FAKE_TOKENS, FAKE_TOKENS / 4)))
+    return [random.choice(WORDS) for _ in range(n)]
+
+async def _first_token_delay():
+    await asyncio.sleep(max(0.0, random.gauss(FAKE_LATENCY_MS, FAKE_JITTER_MS)) / 1000)
+
+@app.post('/v1/chat/completions')
+async def chat_completions(request: Request):
+    body = await request.json()
+    counters["requests"] += 1
+    if random.random() < FAKE_ERROR_RATE:
+        counters["errors"] += 1
+        await _first_token_delay()
+        return JSONResponse(status_code=500, content={"error": {"message": "fake upstream error", "type": "server_error"}})
+    model = body.get('model', 'fake')
+    created = int(time.time())
+    words = _reply_words()
+    prompt_tokens = sum(len(m.get('content') or '') for m in body.get('messages', [])) // 4
+    if body.get('stream'):
+        counters["streams"] += 1
+
+        async def events():
+            await _first_token_delay()
+            for i, word in enumerate(words):
+                chunk = {"id": "fake", "object": "chat.completion.chunk", "created": created, "model": model,
+                         "choices": [{"index": 0, "delta": {"content": word if i == 0 else ' ' + word}, "finish_reason": None}]}
+                yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+                await asyncio.sleep(FAKE_TOKEN_MS / 1000)
+            done = {"id": "fake", "object": "chat.completion.chunk", "created": created, "model": model,
+                    "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+            yield f"data: {json.dumps(done)}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type='text/event-stream')
+    await _first_token_delay()
+    await asyncio.sleep(len(words) * FAKE_TOKEN_MS / 1000)
+    return {
+        "id": "fake", "object": "chat.completion", "created": created, "model": model,
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": ' '.join(words)}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(words), "total_tokens": prompt_tokens + len(words)},
+    }
+
+@app.get('/stats')
+async def get_stats():
+    return counters
+
+def main():
+    global FAKE_LATENCY_MS, FAKE_JITTER_MS, FAKE_TOKEN_MS, FAKE_TOKENS, FAKE_ERROR_RATE
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8766)
+    parser.add_argument('--latency-ms', type=float, default=FAKE_LATENCY_MS)
+    parser.add_argument('--jitter-ms', type=float, default=FAKE_JITTER_MS)
+    parser.add_argument('--token-ms', type=float, default=FAKE_TOKEN_MS)
+    parser.add_argument('--tokens', type=int, default=FAKE_TOKENS)
+    parser.add_argument('--error-rate', type=float, default=FAKE_ERROR_RATE)
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+    FAKE_LATENCY_MS, FAKE_JITTER_MS, FAKE_TOKEN_MS = args.latency_ms, args.jitter_ms, args.token_ms
+    FAKE_TOKENS, FAKE_ERROR_RATE = args.tokens, args.error_rate
+    if args.seed is not None:
+        random.seed(args.seed)
+    uvicorn.run(app, host='127.0.0.1', port=args.port, log_level='warning')
+
+if __name__ == '__main__':
+    main()
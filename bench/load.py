@@ -0,0 +1,325 @@
+"""Нагрузочный прогон: сервер + фейковый OpenAI в подпроцессах, рой WebSocket-клиентов и HTTP-поллеров.
+
+    python -m bench.load --npcs 500 --duration 30 --map-clients 100 --news-clients 50 --chat-clients 10
+    python -m bench.load --baseline bench/results/<прошлый прогон>.json
+    python -m bench.load --compare bench/results/a.json bench/results/b.json
+
+Результаты пишутся в bench/results/<время>-<коммит>.json, чтобы сравнивать регрессии между коммитами.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+import httpx
+import websockets
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(ROOT, 'bench', 'results')
+
+def pct(xs, p):
+    xs = sorted(xs)
+    return round(xs[min(len(xs) - 1, int(len(xs) * p))] * 1000, 1) if xs else 0.0
+
+def summary(xs):
+    return {"count": len(xs), "p50_ms": pct(xs, 0.5), "p99_ms": pct(xs, 0.99), "max_ms": pct(xs, 1.0)}
+
+def rss_kib(pid: int):
+    # VmRSS/VmHWM из /proc (Linux); на других ОС — None
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            fields = dict(line.split(':', 1) for line in f if ':' in line)
+        return {"rss_kib": int(fields['VmRSS'].split()[0]), "peak_kib": int(fields['VmHWM'].split()[0])}
+    except (OSError, KeyError):
+        return None
+
+def git_rev():
+    try:
+        rev = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+        return rev + ('-dirty' if dirty else '') if rev else 'unknown'
+    except OSError:
+        return 'unknown'
+
+class Recorder:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.http = {}  # route -> [сек]
+        self.http_errors = 0
+        self.ws_frames = {}  # топик -> кадров
+        self.ws_bytes = {}
+        self.ws_errors = 0
+        self.chat_ttft = []
+        self.chat_total = []
+        self.news_delivery = []  # Задержка доставки новости каждому подписчику
+        self.news_fanout = []  # От POST /issue_law до последнего подписчика
+        self.news_sent = {}  # текст закона -> (время отправки, [время получения])
+        self.rss = []
+
+    def frame(self, topic: str, size: int):
+        self.ws_frames[topic] = self.ws_frames.get(topic, 0) + 1
+        self.ws_bytes[topic] = self.ws_bytes.get(topic, 0) + size
+
+async def wait_ready(url: str, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                if (await client.get(url)).status_code < 500:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} не поднялся за {timeout} с")
+
+async def map_client(ws_url, rate, rec, stop):
+    topic = f"map_update:{rate}"
+    try:
+        async with websockets.connect(f"{ws_url}/ws/map_update?rate={rate}", max_size=None) as ws:
+            while not stop.is_set():
+                try:
+                    frame = await asyncio.wait_for(ws.recv(), timeout=0.5)
+                except asyncio.TimeoutError:
+                    continue
+                rec.frame(topic, len(frame))
+    except Exception:
+        rec.ws_errors += 1
+
+async def news_client(ws_url, rec, stop):
+    try:
+        async with websockets.connect(f"{ws_url}/ws/news", max_size=None) as ws:
+            while not stop.is_set():
+                try:
+                    frame = await asyncio.wait_for(ws.recv(), timeout=0.5)
+                except asyncio.TimeoutError:
+                    continue
+                now = time.perf_counter()
+                rec.frame('news', len(frame))
+                data = json.loads(frame).get('data') or {}
+                for law, (sent, received) in rec.news_sent.items():
+                    if law in (data.get('content') or ''):
+                        received.append(now)
+                        rec.news_delivery.append(now - sent)
+                        break
+    except Exception:
+        rec.ws_errors += 1
+
+async def law_issuer(http_url, interval, rec, stop):
+    async with httpx.AsyncClient(base_url=http_url, timeout=30) as client:
+        for i in itertools.count():
+            if stop.is_set():
+                return
+            law = f"bench-law-{i}-{random.random():.6f}"
+            rec.news_sent[law] = (time.perf_counter(), [])
+            try:
+                await client.post('/issue_law', json={"law": law})
+            except httpx.HTTPError:
+                rec.http_errors += 1
+            await asyncio.sleep(interval)
+
+async def chat_client(ws_url, npc_id, interval, rec, stop):
+    topic = f"npc_{npc_id}"
+    try:
+        async with websockets.connect(f"{ws_url}/ws/{topic}", max_size=None) as ws:
+            for i in itertools.count():
+                if stop.is_set():
+                    return
+                started = time.perf_counter()
+                first = None
+                await ws.send(json.dumps({"action": "message", "text": f"Привет #{i} от клиента {npc_id}, как дела?"}))
+                while True:
+                    frame = await asyncio.wait_for(ws.recv(), timeout=60)
+                    rec.frame(topic, len(frame))
+                    kind = json.loads(frame).get('type')
+                    if kind == 'chat_delta' and first is None:
+                        first = time.perf_counter() - started
+                    elif kind == 'chat':
+                        break
+                total = time.perf_counter() - started
+                rec.chat_ttft.append(first if first is not None else total)
+                rec.chat_total.append(total)
+                await asyncio.sleep(random.uniform(0.5, 1.5) * interval)
+    except Exception:
+        rec.ws_errors += 1
+
+async def poller(http_url, routes, interval, rec, stop):
+    async with httpx.AsyncClient(base_url=http_url, timeout=30) as client:
+        for route in itertools.cycle(routes):
+            if stop.is_set():
+                return
+            started = time.perf_counter()
+            try:
+                (await client.get(route)).raise_for_status()
+                rec.http.setdefault(route, []).append(time.perf_counter() - started)
+            except httpx.HTTPError:
+                rec.http_errors += 1
+            await asyncio.sleep(interval)
+
+async def memory_sampler(pid, rec, stop):
+    while not stop.is_set():
+        sample = rss_kib(pid)
+        if sample:
+            rec.rss.append(sample['rss_kib'])
+        await asyncio.sleep(1)
+
+def spawn(args, env, log):
+    return subprocess.Popen([sys.executable, *args], cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+async def run(args):
+    tmp = tempfile.mkdtemp(prefix='city-bench-')
+    log = open(os.path.join(tmp, 'server.log'), 'w')
+    env = dict(os.environ,
+               OPENAI_API_KEY='bench',
+               OPENAI_BASE_URL=f"http://127.0.0.1:{args.ai_port}/v1",
+               SQLITE_URL=f"sqlite:///{os.path.join(tmp, 'bench.db')}",
+               NPC_COUNT=str(args.npcs),
+               NPC_TICK_INTERVAL=str(args.tick_interval),
+               ARCHIVE_DIR=os.path.join(tmp, 'archive'))
+    env.pop('AI_DISK_CACHE', None)
+    fake = spawn(['-m', 'bench.fake_openai', '--port', str(args.ai_port), '--latency-ms', str(args.ai_latency_ms),
+                  '--error-rate', str(args.ai_error_rate), '--seed', str(args.seed)], env, log)
+    server = spawn(['-m', 'uvicorn', 'app.server:app', '--host', '127.0.0.1', '--port', str(args.port), '--log-level', 'warning'], env, log)
+    http_url = f"http://127.0.0.1:{args.port}"
+    ws_url = f"ws://127.0.0.1:{args.port}"
+    rec = Recorder()
+    try:
+        await wait_ready(f"http://127.0.0.1:{args.ai_port}/stats")
+        await wait_ready(http_url + '/')
+        random.seed(args.seed)
+        stop = asyncio.Event()
+        rates = [1, 2, 5, 10]
+        tasks = [asyncio.create_task(memory_sampler(server.pid, rec, stop))]
+        tasks += [asyncio.create_task(map_client(ws_url, rates[i % len(rates)], rec, stop)) for i in range(args.map_clients)]
+        tasks += [asyncio.create_task(news_client(ws_url, rec, stop)) for _ in range(args.news_clients)]
+        tasks += [asyncio.create_task(chat_client(ws_url, npc_id, args.chat_interval, rec, stop))
+                  for npc_id in random.sample(range(1, args.npcs + 1), min(args.chat_clients, args.npcs))]
+        tasks += [asyncio.create_task(poller(http_url, ['/map', '/news'], args.poll_interval, rec, stop)) for _ in range(args.pollers)]
+        await asyncio.sleep(1)  # Подписчики новостей успевают подключиться
+        tasks.append(asyncio.create_task(law_issuer(http_url, args.news_interval, rec, stop)))
+        rec.started = time.perf_counter()
+        await asyncio.sleep(args.duration)
+        elapsed = time.perf_counter() - rec.started
+        stop.set()
+        async with httpx.AsyncClient(base_url=http_url, timeout=30) as client:
+            server_stats = {name: (await client.get(f"/{name}")).json() for name in ('sim_stats', 'ws_stats', 'ai_stats')}
+        memory = rss_kib(server.pid)
+        await asyncio.wait(tasks, timeout=5)
+        for t in tasks:
+            t.cancel()
+    finally:
+        for proc in (server, fake):
+            proc.terminate()
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        log.close()
+    for sent, received in rec.news_sent.values():
+        if received:
+            rec.news_fanout.append(max(received) - sent)
+    frames = sum(rec.ws_frames.values())
+    return {
+        "rev": git_rev(),
+        "time": datetime.utcnow().isoformat(timespec='seconds'),
+        "params": vars(args),
+        "duration_s": round(elapsed, 2),
+        "http": {route: summary(xs) for route, xs in sorted(rec.http.items())},
+        "http_errors": rec.http_errors,
+        "chat_ttft": summary(rec.chat_ttft),
+        "chat_total": summary(rec.chat_total),
+        "news_delivery": summary(rec.news_delivery),
+        "news_fanout": summary(rec.news_fanout),
+        "ws_frames_per_s": round(frames / elapsed, 1),
+        "ws_kib_per_s": round(sum(rec.ws_bytes.values()) / elapsed / 1024, 1),
+        "ws_frames": rec.ws_frames,
+        "ws_errors": rec.ws_errors,
+        "memory": dict(memory or {}, rss_max_sampled_kib=max(rec.rss) if rec.rss else None),
+        "server": server_stats,
+        "log": os.path.join(tmp, 'server.log'),
+    }
+
+# Метрики для сравнения прогонов: (путь в JSON, меньше — лучше)
+KEY_METRICS = [
+    (("http", "/map", "p50_ms"), True), (("http", "/map", "p99_ms"), True),
+    (("http", "/news", "p50_ms"), True), (("http", "/news", "p99_ms"), True),
+    (("chat_ttft", "p50_ms"), True), (("chat_ttft", "p99_ms"), True),
+    (("chat_total", "p50_ms"), True), (("chat_total", "p99_ms"), True),
+    (("news_fanout", "p50_ms"), True), (("news_fanout", "p99_ms"), True),
+    (("ws_frames_per_s",), False), (("memory", "peak_kib"), True),
+]
+
+def lookup(result, path):
+    node = result
+    for part in path:
+        if not isinstance(node, dict) or part not in node:
+            return None
+        node = node[part]
+    return node
+
+def print_result(result):
+    print(f"rev {result['rev']}  {result['duration_s']} s  npcs={result['params']['npcs']}")
+    for route, s in result['http'].items():
+        print(f"  GET {route:<14} p50 {s['p50_ms']:8.1f} ms  p99 {s['p99_ms']:8.1f} ms  n={s['count']}")
+    for name in ('chat_ttft', 'chat_total', 'news_delivery', 'news_fanout'):
+        s = result[name]
+        print(f"  {name:<18} p50 {s['p50_ms']:8.1f} ms  p99 {s['p99_ms']:8.1f} ms  n={s['count']}")
+    print(f"  ws {result['ws_frames_per_s']} frames/s, {result['ws_kib_per_s']} KiB/s, errors {result['ws_errors']}, http errors {result['http_errors']}")
+    print(f"  memory {result['memory']}")
+
+def compare(old, new):
+    print(f"{'metric':<22} {old['rev']:>14} {new['rev']:>14}   change")
+    for path, lower_better in KEY_METRICS:
+        a, b = lookup(old, path), lookup(new, path)
+        if a is None or b is None:
+            continue
+        change = (b - a) / a * 100 if a else 0.0
+        worse = change > 10 if lower_better else change < -10
+        print(f"{'.'.join(path):<22} {a:>14} {b:>14}   {change:+6.1f}%{'  <- регрессия' if worse else ''}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--npcs', type=int, default=200)
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--map-clients', type=int, default=50)
+    parser.add_argument('--news-clients', type=int, default=20)
+    parser.add_argument('--chat-clients', type=int, default=10)
+    parser.add_argument('--chat-interval', type=float, default=2.0)
+    parser.add_argument('--pollers', type=int, default=5)
+    parser.add_argument('--poll-interval', type=float, default=0.2)
+    parser.add_argument('--news-interval', type=float, default=1.0)
+    parser.add_argument('--tick-interval', type=float, default=1.0)
+    parser.add_argument('--ai-latency-ms', type=float, default=300)
+    parser.add_argument('--ai-error-rate', type=float, default=0.0)
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--ai-port', type=int, default=8766)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--out', default=None, help='Файл результата (по умолчанию bench/results/<время>-<коммит>.json)')
+    parser.add_argument('--baseline', default=None, help='Сравнить с сохранённым прогоном')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='Только сравнить два сохранённых прогона')
+    args = parser.parse_args()
+    if args.compare:
+        old, new = (json.load(open(p)) for p in args.compare)
+        compare(old, new)
+        return
+    baseline, out = args.baseline, args.out
+    for name in ('baseline', 'out', 'compare'):
+        delattr(args, name)
+    result = asyncio.run(run(args))
+    print_result(result)
+    if out is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        out = os.path.join(RESULTS_DIR, f"{datetime.utcnow():%Y%m%d-%H%M%S}-{result['rev']}.json")
+    with open(out, 'w') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"Сохранено: {out}")
+    if baseline:
+        compare(json.load(open(baseline)), result)
+
+if __name__ == '__main__':
+    main()
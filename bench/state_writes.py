@@ -0,0 +1,111 @@
+"""Объём записи за тик: JSON-блоб npcs.state (как было) против колонок + таблицы relations.
+
+    python -m bench.state_writes --npcs 500 --ticks 20
+"""
+import argparse
+import random
+from sqlalchemy import Column, Integer, String, Float, JSON, create_engine, event, select
+from sqlalchemy.orm import Session, declarative_base
+from app.db import Base
+from app.models import NPC, Relation
+
+LegacyBase = declarative_base()
+
+class LegacyNPC(LegacyBase):
+    __tablename__ = 'npcs_legacy'
+    id = Column(Integer, primary_key=True)
+    name = Column(String, unique=True)
+    state = Column(JSON)
+    x = Column(Float, default=0.0)
+    y = Column(Float, default=0.0)
+
+class WriteCounter:
+    def __init__(self, engine):
+        self.statements = 0
+        self.bytes = 0
+        event.listen(engine, 'before_cursor_execute', self.on_execute)
+
+    def on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if not statement.lstrip().upper().startswith(('UPDATE', 'INSERT')):
+            return
+        rows = parameters if executemany else [parameters]
+        for params in rows:
+            self.statements += 1
+            values = params.values() if isinstance(params, dict) else params
+            self.bytes += len(statement) + sum(len(str(v).encode()) for v in values)
+
+    def reset(self):
+        self.statements = self.bytes = 0
+
+def pick_action(rng):
+    return rng.choice(['move', 'chat', 'work', 'shop', 'business', 'disaster'])
+
+def run_legacy(n, ticks, seed):
+    rng = random.Random(seed)
+    engine = create_engine('sqlite://')
+    LegacyBase.metadata.create_all(engine)
+    names = [f"npc{i}" for i in range(n)]
+    with Session(engine) as db:
+        db.add_all([LegacyNPC(name=name, state={"mood": "neutral", "money": 100, "location": "home", "business": None,
+                                                 "relations": {o: rng.choice(['friend', 'neutral', 'enemy']) for o in names if o != name}})
+                    for name in names])
+        db.commit()
+    counter = WriteCounter(engine)
+    for _ in range(ticks):
+        with Session(engine) as db:
+            for npc in db.scalars(select(LegacyNPC)):
+                s = dict(npc.state)  # Старый код переписывал весь блоб целиком
+                action = pick_action(rng)
+                if action == 'move':
+                    npc.x, npc.y = rng.random() * 800, rng.random() * 400
+                    s['location'] = rng.choice(['home', 'shop', 'work', 'park'])
+                elif action == 'chat':
+                    s['relations'] = dict(s['relations'], **{rng.choice(names): 'friend'})
+                elif action in ('work', 'shop', 'business'):
+                    s['money'] += rng.randint(-15, 20)
+                else:
+                    continue
+                npc.state = s
+            db.commit()
+    return counter
+
+def run_columns(n, ticks, seed):
+    rng = random.Random(seed)
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine, tables=[NPC.__table__, Relation.__table__])
+    with Session(engine) as db:
+        npcs = [NPC(name=f"npc{i}", mood="neutral", money=100, location="home") for i in range(n)]
+        db.add_all(npcs)
+        db.flush()
+        db.add_all([Relation(npc_id=a.id, other_id=b.id, kind=rng.choice(['friend', 'neutral', 'enemy'])) for a in npcs for b in npcs if a is not b])
+        db.commit()
+    counter = WriteCounter(engine)
+    for _ in range(ticks):
+        with Session(engine) as db:
+            for npc in db.scalars(select(NPC)):
+                action = pick_action(rng)
+                if action == 'move':
+                    npc.x, npc.y = rng.random() * 800, rng.random() * 400
+                    npc.location = rng.choice(['home', 'shop', 'work', 'park'])
+                elif action == 'chat':
+                    other = rng.randint(1, n)
+                    rel = db.scalar(select(Relation).where(Relation.npc_id == npc.id, Relation.other_id == other))
+                    if rel:
+                        rel.kind = 'friend'
+                elif action in ('work', 'shop', 'business'):
+                    npc.money += rng.randint(-15, 20)
+            db.commit()
+    return counter
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--npcs', type=int, default=500)
+    parser.add_argument('--ticks', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    for label, fn in (('json_state', run_legacy), ('columns', run_columns)):
+        c = fn(args.npcs, args.ticks, args.seed)
+        print(f"{label:>10}: {c.statements / args.ticks:8.1f} writes/tick  {c.bytes / args.ticks / 1024:10.1f} KiB/tick")
+
+if __name__ == '__main__':
+    main()
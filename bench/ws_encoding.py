@@ -0,0 +1,82 @@
+"""Размер кадра и CPU сериализации WebSocket-рассылок: JSON против MessagePack, с permessage-deflate и без.
+
+    python -m bench.ws_encoding --npcs 500 --changed 50 --frames 200
+
+Кадры строятся как в рассылках сервера (map_delta, map_snapshot, state_update, news). Сериализация
+считается один раз на рассылку (broadcast кодирует один раз на кодировку), сжатие — на соединение:
+permessage-deflate со скользящим словарём, как его делает websockets.
+"""
+import argparse
+import random
+import time
+import zlib
+from app.chat_ws import encode, pack, msgpack, orjson
+
+LOCATIONS = ['home', 'shop', 'work', 'park', 'mayor_office']
+LOCATION_IDS = {name: i + 1 for i, name in enumerate(LOCATIONS)}
+NAMES = ['Анна', 'Пётр', 'Оля', 'Игорь', 'Мария', 'Сергей', 'Лена', 'Дмитрий', 'Ирина', 'Николай']
+
+def make_npcs(n, rng):
+    return {i: {"id": i, "name": f"{rng.choice(NAMES)} {i}", "profession": "Бариста", "x": rng.uniform(0, 800),
+                "y": rng.uniform(0, 400), "mood": "neutral", "money": rng.randint(0, 500),
+                "location": rng.choice(LOCATIONS), "business": None} for i in range(1, n + 1)}
+
+def frames(kind, npcs, changed, count, rng):
+    # count кадров одного типа подряд — так их видит сжатие одного соединения
+    out = []
+    for version in range(count):
+        if kind == 'map_delta':
+            ids = rng.sample(list(npcs), changed)
+            data = {"version": version, "since": version - 1, "full": False,
+                    "npcs": {str(i): {"x": rng.uniform(0, 800), "y": rng.uniform(0, 400), "location": rng.choice(LOCATIONS)} for i in ids}}
+        elif kind == 'map_snapshot':
+            data = {"version": version, "full": True, "npcs": {str(i): dict(npc) for i, npc in npcs.items()}}
+        elif kind == 'state_update':
+            npc = npcs[rng.choice(list(npcs))]
+            data = {"id": npc['id'], "state": {"mood": npc['mood'], "money": npc['money'] + version, "location": npc['location'], "business": None}}
+        else:
+            data = {"id": version + 1, "title": "Новый закон", "content": f"Мэр объявил: закон номер {version}.", "ts": "2026-10-18 12:00:00.000000"}
+        out.append({"type": kind, "data": data})
+    return out
+
+def deflate_stream(payloads):
+    # permessage-deflate с context takeover: один компрессор на соединение, хвост 00 00 ff ff не передаётся
+    comp = zlib.compressobj(6, zlib.DEFLATED, -15)
+    sizes = []
+    started = time.perf_counter()
+    for p in payloads:
+        data = p.encode() if isinstance(p, str) else p
+        sizes.append(len(comp.compress(data) + comp.flush(zlib.Z_SYNC_FLUSH)) - 4)
+    return sizes, (time.perf_counter() - started) / len(payloads)
+
+def measure(messages, encoder):
+    started = time.perf_counter()
+    payloads = [encoder(m) for m in messages]
+    encode_s = (time.perf_counter() - started) / len(messages)
+    raw = [len(p.encode() if isinstance(p, str) else p) for p in payloads]
+    deflated, deflate_s = deflate_stream(payloads)
+    return {"bytes": sum(raw) / len(raw), "deflate_bytes": sum(deflated) / len(deflated),
+            "encode_us": encode_s * 1e6, "deflate_us": deflate_s * 1e6}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--npcs', type=int, default=500)
+    parser.add_argument('--changed', type=int, default=50, help='NPC в одной дельте карты')
+    parser.add_argument('--frames', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    if msgpack is None:
+        raise SystemExit("msgpack не установлен: pip install msgpack")
+    rng = random.Random(args.seed)
+    npcs = make_npcs(args.npcs, rng)
+    encoders = {"json" + ("(orjson)" if orjson else ""): encode, "msgpack": lambda m: pack(m, LOCATION_IDS)}
+    print(f"{'frame':>13} {'encoding':>14} {'bytes':>9} {'+deflate':>9} {'encode us':>10} {'deflate us':>11}")
+    for kind in ('map_delta', 'map_snapshot', 'state_update', 'news'):
+        count = max(1, args.frames // 20) if kind == 'map_snapshot' else args.frames
+        messages = frames(kind, npcs, min(args.changed, args.npcs), count, rng)
+        for name, encoder in encoders.items():
+            r = measure(messages, encoder)
+            print(f"{kind:>13} {name:>14} {r['bytes']:>9.0f} {r['deflate_bytes']:>9.0f} {r['encode_us']:>10.1f} {r['deflate_us']:>11.1f}")
+
+if __name__ == '__main__':
+    main()